@@ -14,6 +14,18 @@ app = Celery('datauploader')
 app.conf.broker_url = os.getenv('REDIS_URL', 'redis://')
 app.conf.result_backend = os.getenv('REDIS_URL', 'redis://')
 
+# Redis redelivers a task not acknowledged within the visibility timeout,
+# which includes the countdown of a scheduled task. update_data schedules
+# syncs hours ahead, so this must outlast its longest countdown.
+app.conf.broker_transport_options = {'visibility_timeout': 12 * 60 * 60}
+
+# Stages of a sync run on their own workers: fetches are bound by the
+# Withings rate limit, uploads by Open Humans and S3 I/O.
+app.conf.task_routes = {
+    'datauploader.tasks.fetch_nokia_endpoint': {'queue': 'nokia_fetch'},
+    'datauploader.tasks.upload_nokia': {'queue': 'nokia_upload'},
+}
+
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
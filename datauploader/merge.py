@@ -0,0 +1,157 @@
+"""
+Keyed merging of newly fetched Withings records into existing data.
+"""
+import heapq
+import itertools
+from datetime import datetime, timezone
+
+
+def record_month(value):
+    """
+    The YYYY-MM month of a Withings date, given as epoch seconds or as a
+    YYYY-MM-DD string.
+    """
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return datetime.fromtimestamp(int(value), timezone.utc).strftime(
+            '%Y-%m')
+    return value[:7]
+
+
+class RecordMerger(object):
+    """
+    Merge pages of records into an endpoint's existing records. A record
+    replaces the existing one with the same key, and the records are kept
+    sorted by date. Keys are indexed once per sync, so merging stays linear
+    in the number of records however many pages arrive. The months of the
+    records merged after the existing ones are kept in touched_months.
+    """
+
+    def __init__(self, records, key_fields, date_field):
+        self.key_fields = key_fields
+        self.date_field = date_field
+        self.records = []
+        self._index = {}
+        self._sorted = True
+        self.touched_months = set()
+        self.merge(records or [])
+        self.touched_months.clear()
+
+    def merge(self, new_records):
+        for record in new_records:
+            if record.get(self.date_field) is not None:
+                self.touched_months.add(record_month(record[self.date_field]))
+            key = self._key(record)
+            position = self._index.get(key)
+            if position is None:
+                if self.records and self._sort_key(record) < \
+                        self._sort_key(self.records[-1]):
+                    self._sorted = False
+                self._index[key] = len(self.records)
+                self.records.append(record)
+            else:
+                if self._sort_key(record) != \
+                        self._sort_key(self.records[position]):
+                    self._sorted = False
+                self.records[position] = record
+
+    def sorted_records(self):
+        # Newer pages mostly append, so this rarely has anything to do
+        if not self._sorted:
+            self.records.sort(key=self._sort_key)
+            self._index = {self._key(record): position
+                           for position, record in enumerate(self.records)}
+            self._sorted = True
+        return self.records
+
+    def merged_with(self, existing):
+        """
+        Yield the records merged so far among existing records sorted the
+        same way, such as those of a file written from sorted_records,
+        replacing the existing records with the same key. Only the merged
+        records are held; the existing ones are passed through as they come.
+        """
+        records = self.sorted_records()
+        return heapq.merge(
+            (record for record in existing
+             if self._key(record) not in self._index),
+            records, key=self._sort_key)
+
+    def _key(self, record):
+        return tuple(record.get(field) for field in self.key_fields)
+
+    def _sort_key(self, record):
+        return (record.get(self.date_field), self._key(record))
+
+
+class SeriesMerger(object):
+    """
+    Merge intraday series, which map timestamps to measurements, keeping
+    them in timestamp order. Newer measurements replace older ones.
+    """
+
+    def __init__(self, series):
+        self.series = {}
+        self._latest = None
+        self._sorted = True
+        self.touched_months = set()
+        self.merge(series if isinstance(series, dict) else {})
+        self.touched_months.clear()
+
+    def merge(self, new_series):
+        for timestamp, measurement in new_series.items():
+            self.touched_months.add(record_month(timestamp))
+            if timestamp not in self.series:
+                if self._latest is not None and int(timestamp) < self._latest:
+                    self._sorted = False
+                else:
+                    self._latest = int(timestamp)
+            self.series[timestamp] = measurement
+
+    def sorted_records(self):
+        if not self._sorted:
+            self.series = dict(sorted(self.series.items(),
+                                      key=lambda item: int(item[0])))
+            self._sorted = True
+        return self.series
+
+    def merged_with(self, existing):
+        """
+        Yield the (timestamp, measurement) pairs merged so far among existing
+        pairs in timestamp order, replacing the existing measurements at the
+        same timestamps. The existing pairs are passed through as they come.
+        """
+        series = self.sorted_records()
+        return heapq.merge(
+            ((timestamp, measurement) for timestamp, measurement in existing
+             if timestamp not in series),
+            series.items(), key=lambda item: int(item[0]))
+
+
+def merger_for(endpoint, records):
+    """
+    Return the merger of an endpoint, seeded with its existing records.
+    Duplicates already in the existing records are dropped, keeping the
+    last one.
+    """
+    if endpoint['key'] is None:
+        return SeriesMerger(records)
+    return RecordMerger(records, endpoint['key'], endpoint['date_key'])
+
+
+def group_by_month(endpoint, records):
+    """
+    Split an endpoint's records, sorted by date, into months as they come,
+    yielding each month with its records. Series are given as a dict or as
+    (timestamp, measurement) pairs.
+    """
+    if endpoint['key'] is None:
+        if isinstance(records, dict):
+            records = records.items()
+        for month, measurements in itertools.groupby(
+                records or (), key=lambda item: record_month(item[0])):
+            yield month, dict(measurements)
+    else:
+        for month, month_records in itertools.groupby(
+                records or (),
+                key=lambda record: record_month(record[endpoint['date_key']])):
+            yield month, list(month_records)
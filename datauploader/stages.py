@@ -0,0 +1,74 @@
+"""
+Results handed from one stage of a sync to the next, kept in Redis.
+"""
+import json
+import zlib
+
+# Seconds a sync's intermediate results are kept, in case it never finishes
+STAGE_TTL = 6 * 60 * 60
+
+
+class StageStore(object):
+    """
+    zlib-compressed JSON values in Redis, grouped by sync run. Besides its
+    value, each stage has a list of items it appends to one at a time, so
+    results that grow over retries are never written out again. Every key
+    expires on its own, so a failed run leaves nothing behind for long.
+    """
+
+    def __init__(self, redis, ttl=STAGE_TTL, batch_size=100):
+        self.redis = redis
+        self.ttl = ttl
+        self.batch_size = batch_size
+
+    def put(self, run_id, name, value):
+        self.redis.set(self._key(run_id, name), self._encode(value),
+                       ex=self.ttl)
+
+    def get(self, run_id, name):
+        data = self.redis.get(self._key(run_id, name))
+        if data is None:
+            return None
+        return self._decode(data)
+
+    def append(self, run_id, name, item):
+        key = self._items_key(run_id, name)
+        pipeline = self.redis.pipeline()
+        pipeline.rpush(key, self._encode(item))
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+
+    def items(self, run_id, name):
+        """
+        Yield the items appended to a stage, in order, a batch at a time.
+        """
+        key = self._items_key(run_id, name)
+        start = 0
+        while True:
+            batch = self.redis.lrange(key, start, start + self.batch_size - 1)
+            for data in batch:
+                yield self._decode(data)
+            if len(batch) < self.batch_size:
+                return
+            start += len(batch)
+
+    def has_items(self, run_id, name):
+        return self.redis.llen(self._items_key(run_id, name)) > 0
+
+    def delete(self, run_id, names):
+        keys = []
+        for name in names:
+            keys += [self._key(run_id, name), self._items_key(run_id, name)]
+        self.redis.delete(*keys)
+
+    def _encode(self, value):
+        return zlib.compress(json.dumps(value).encode('utf-8'))
+
+    def _decode(self, data):
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+
+    def _key(self, run_id, name):
+        return 'nokia:stage:{}:{}'.format(run_id, name)
+
+    def _items_key(self, run_id, name):
+        return self._key(run_id, name) + ':items'
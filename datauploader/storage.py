@@ -0,0 +1,381 @@
+"""
+Reading and writing the nokiahealthdata files stored in Open Humans.
+"""
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import types
+
+import ijson
+import requests
+
+# Bytes read from the network at a time
+CHUNK_SIZE = 64 * 1024
+
+# Containers this many levels down an endpoint section (the section, its body
+# and the records in it) are written item by item, anything deeper at once.
+SECTION_DEPTH = 3
+
+# Formats files are uploaded in (see NOKIA_FILE_FORMAT), by filename extension
+FILE_FORMATS = {
+    'json': '.json',
+    'json.gz': '.json.gz',
+    'ndjson': '.ndjson',
+}
+
+
+def file_format(filename):
+    """
+    The format of a file, judging by its extension.
+    """
+    for name, extension in FILE_FORMATS.items():
+        if filename.endswith(extension) and name != 'json':
+            return name
+    return 'json'
+
+
+def download_file(url, path):
+    """
+    Download url to path without holding the whole body in memory.
+    """
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as out_file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                out_file.write(chunk)
+
+
+def download_json(url):
+    """
+    Download and parse a small JSON file, such as the manifest.
+    """
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.json()
+
+
+class NokiaFile(object):
+    """
+    Existing Nokia data, read from a nokiahealthdata.json on disk. Endpoint
+    sections are parsed incrementally the first time they are used, so a sync
+    holds the sections it touches rather than the whole file. Sections set on
+    it replace the ones from the file. Without a path it starts out empty.
+    basename and metadata are those of the uploaded file it was read from.
+    """
+
+    def __init__(self, path=None, directory=None, basename=None,
+                 metadata=None):
+        self.path = path
+        self.directory = directory
+        self.basename = basename
+        self.metadata = metadata or {}
+        self._keys = None if path else []
+        self._sections = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def download(cls, url, basename='nokiahealthdata.json', metadata=None):
+        """
+        Download a file in any of the FILE_FORMATS, unpacked to plain JSON
+        on disk as it goes.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'nokiahealthdata.json')
+        try:
+            if file_format(basename) == 'json':
+                download_file(url, path)
+            else:
+                download_path = os.path.join(directory, 'download')
+                download_file(url, download_path)
+                opener = gzip.open if file_format(basename) == 'json.gz' \
+                    else open
+                with opener(download_path, 'rt',
+                            encoding='utf-8') as in_file, \
+                        open(path, 'w') as out_file:
+                    if file_format(basename) == 'ndjson':
+                        _ndjson_to_json(in_file, out_file)
+                    else:
+                        shutil.copyfileobj(in_file, out_file, CHUNK_SIZE)
+                os.remove(download_path)
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return cls(path, directory, basename, metadata)
+
+    def keys(self):
+        with self._lock:
+            if self._keys is None:
+                with open(self.path, 'rb') as in_file:
+                    self._keys = [value for prefix, event, value
+                                  in ijson.parse(in_file)
+                                  if prefix == '' and event == 'map_key']
+            return list(self._keys)
+
+    def items(self):
+        for name in self.keys():
+            yield name, self[name]
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        with self._lock:
+            if name not in self._sections:
+                print("parsing existing {} data".format(name))
+                with open(self.path, 'rb') as in_file:
+                    self._sections[name] = next(
+                        ijson.items(in_file, name, use_float=True))
+            return self._sections[name]
+
+    def is_parsed(self, name):
+        with self._lock:
+            return name in self._sections
+
+    def section_events(self, name):
+        """
+        Yield the (event, value) pairs of a section straight from the file.
+        """
+        for prefix, event, value in self._section_parse(name):
+            yield event, value
+
+    def split_section(self, name, records_key, placeholder=False):
+        """
+        Read a section without the records under records_key in its body,
+        and return it with the records, read one at a time from the file,
+        and whether they are a series. The records are an iterator of records
+        or, for series, of (timestamp, measurement) pairs, or None if the
+        section has none. With placeholder, records_key stays in the body set
+        to None, so records put back there keep their place in it.
+        """
+        records_prefix = '{}.body.{}'.format(name, records_key)
+        builder = ijson.ObjectBuilder()
+        records_event = None
+        for prefix, event, value in self._section_parse(name):
+            if prefix == records_prefix and records_event is None:
+                records_event = event
+            if prefix == records_prefix or \
+                    prefix.startswith(records_prefix + '.'):
+                continue
+            if prefix == name + '.body' and event == 'map_key' and \
+                    value == records_key:
+                if placeholder:
+                    builder.event(event, value)
+                    builder.event('null', None)
+                continue
+            builder.event(event, value)
+        if records_event == 'start_array':
+            records = self._stream(ijson.items, records_prefix + '.item')
+        elif records_event == 'start_map':
+            records = self._stream(ijson.kvitems, records_prefix)
+        else:
+            records = None
+        return builder.value, records, records_event == 'start_map'
+
+    def _section_parse(self, name):
+        started = False
+        with open(self.path, 'rb') as in_file:
+            for prefix, event, value in ijson.parse(in_file, use_float=True):
+                if prefix == name or prefix.startswith(name + '.'):
+                    started = True
+                    yield prefix, event, value
+                elif started:
+                    break
+
+    def _stream(self, parse, prefix):
+        with open(self.path, 'rb') as in_file:
+            for item in parse(in_file, prefix, use_float=True):
+                yield item
+
+    def __setitem__(self, name, section):
+        self.keys()
+        with self._lock:
+            if name not in self._keys:
+                self._keys.append(name)
+            self._sections[name] = section
+
+    def close(self):
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def write_json(out_file, nokia_data):
+    """
+    Write nokia_data exactly as json.dump(nokia_data, out_file) would, one
+    endpoint section and one record at a time, taking records from lists or
+    generators and series from dicts or Series. Sections of a NokiaFile that
+    were never parsed are copied from its file event by event without being
+    built.
+    """
+    out_file.write('{')
+    for position, name in enumerate(nokia_data):
+        if position:
+            out_file.write(', ')
+        out_file.write(json.dumps(name) + ': ')
+        if isinstance(nokia_data, NokiaFile) and \
+                not nokia_data.is_parsed(name):
+            _write_events(out_file, nokia_data.section_events(name))
+        else:
+            _write_value(out_file, nokia_data[name], SECTION_DEPTH)
+    out_file.write('}')
+
+
+def write_file(path, nokia_data, file_format, records_keys):
+    """
+    Write nokia_data to path in one of the FILE_FORMATS, compressing as it
+    goes. records_keys maps endpoint names to where their records are.
+    Returns the SHA-256 hex digest of the content before compression, which
+    unlike the gzip file doesn't change with the time it was written.
+    """
+    opener = gzip.open if file_format == 'json.gz' else open
+    with opener(path, 'wt', encoding='utf-8') as out_file:
+        hashing_file = _HashingWriter(out_file)
+        if file_format == 'ndjson':
+            write_ndjson(hashing_file, nokia_data, records_keys)
+        else:
+            write_json(hashing_file, nokia_data)
+    return hashing_file.sha256.hexdigest()
+
+
+class _HashingWriter(object):
+    # Hashes the text written to a file on its way through
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.sha256 = hashlib.sha256()
+
+    def write(self, text):
+        self.sha256.update(text.encode('utf-8'))
+        self.out_file.write(text)
+
+
+def write_ndjson(out_file, nokia_data, records_keys):
+    """
+    Write nokia_data as newline-delimited JSON: a line with each endpoint
+    section minus its records, then a line per record, or per timestamp of a
+    series. Sections of a NokiaFile that were never parsed are read from its
+    file a record at a time.
+    """
+    for name in nokia_data:
+        records_key = records_keys.get(name)
+        records, series = None, False
+        if records_key is None:
+            section = nokia_data[name]
+        elif isinstance(nokia_data, NokiaFile) and \
+                not nokia_data.is_parsed(name):
+            section, records, series = nokia_data.split_section(
+                name, records_key)
+        else:
+            section = nokia_data[name]
+            body = section.get('body') if isinstance(section, dict) else None
+            if isinstance(body, dict) and records_key in body:
+                body = dict(body)
+                records = body.pop(records_key)
+                section = dict(section, body=body)
+                series = isinstance(records, (dict, Series))
+                if isinstance(records, dict):
+                    records = records.items()
+                elif series:
+                    records = records.pairs
+        header = {'endpoint': name, 'section': section}
+        if records is not None:
+            header.update({'records': records_key, 'series': series})
+        out_file.write(json.dumps(header) + '\n')
+        for record in records or ():
+            if series:
+                line = {'endpoint': name, 'timestamp': record[0],
+                        'record': record[1]}
+            else:
+                line = {'endpoint': name, 'record': record}
+            out_file.write(json.dumps(line) + '\n')
+
+
+def _ndjson_to_json(in_file, out_file):
+    # The sections of write_ndjson, as json.dump would write them, keeping
+    # one record in memory at a time
+    lines = (json.loads(line) for line in in_file if line.strip())
+    out_file.write('{')
+    sections = itertools.groupby(lines, key=lambda line: line['endpoint'])
+    for position, (name, section_lines) in enumerate(sections):
+        if position:
+            out_file.write(', ')
+        out_file.write(json.dumps(name) + ': ')
+        header = next(section_lines)
+        section = header['section']
+        if 'records' in header:
+            if header['series']:
+                records = Series((line['timestamp'], line['record'])
+                                 for line in section_lines)
+            else:
+                records = (line['record'] for line in section_lines)
+            section['body'][header['records']] = records
+        _write_value(out_file, section, SECTION_DEPTH)
+    out_file.write('}')
+
+
+class Series(object):
+    """
+    (timestamp, measurement) pairs, such as a series merged as it's read,
+    written as a JSON object.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+
+def _write_value(out_file, value, depth):
+    if depth and isinstance(value, (dict, Series)):
+        out_file.write('{')
+        pairs = value.items() if isinstance(value, dict) else value.pairs
+        for position, (key, item) in enumerate(pairs):
+            if position:
+                out_file.write(', ')
+            out_file.write(json.dumps(key) + ': ')
+            _write_value(out_file, item, depth - 1)
+        out_file.write('}')
+    elif depth and isinstance(value, (list, types.GeneratorType)):
+        out_file.write('[')
+        for position, item in enumerate(value):
+            if position:
+                out_file.write(', ')
+            _write_value(out_file, item, depth - 1)
+        out_file.write(']')
+    else:
+        out_file.write(json.dumps(value))
+
+
+def _write_events(out_file, events):
+    # One [is array, has items] pair per open container
+    containers = [[False, False]]
+    for event, value in events:
+        if event in ('end_map', 'end_array'):
+            containers.pop()
+            out_file.write('}' if event == 'end_map' else ']')
+            continue
+        container = containers[-1]
+        if event == 'map_key' or container[0]:
+            if container[1]:
+                out_file.write(', ')
+            container[1] = True
+        if event == 'map_key':
+            out_file.write(json.dumps(value) + ': ')
+        elif event == 'start_map':
+            out_file.write('{')
+            containers.append([False, False])
+        elif event == 'start_array':
+            out_file.write('[')
+            containers.append([True, False])
+        else:
+            out_file.write(json.dumps(value))
@@ -4,254 +4,795 @@ These tasks:
   1. delete any current files in OH if they match the planned upload filename
   2. adds a data file
 """
+import calendar
+import json
 import logging
+import math
 import os
-import json
 import shutil
 import tempfile
-import requests
+import uuid
 import arrow
-import time
-import ast
 import dateutil.parser as dp
 
-from celery import shared_task
+from celery import chain, chord, shared_task
 from django.conf import settings
 from requests_oauthlib import OAuth1
 from open_humans.models import OpenHumansMember
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from main.models import NokiaSyncCursor
 from nokia.settings import rr
 from requests_respectful import RequestsRespectfulRateLimitedError
 from ohapi import api
+from . import merge, stages, storage, withings
 
 
 # Set up logging.
 logger = logging.getLogger(__name__)
 
+# Withings endpoints, with the longest time window (in days) asked for at once
+# and whether dates are passed as YYYY-MM-DD days or as epoch seconds.
+# Records under the 'records' key of the body are merged across pages, one
+# per distinct 'key' fields, and kept sorted by their 'date_key' field.
+# Endpoints taking 'lastupdate' can be asked for everything changed since the
+# previous sync.
+NOKIA_ENDPOINTS = [
+    {'name': 'activity',
+     'url': 'https://wbsapi.withings.net/v2/measure',
+     'action': 'getactivity', 'dates': 'ymd', 'window': 90,
+     'records': 'activities', 'key': ['date'],
+     'date_key': 'date', 'lastupdate': True},
+    {'name': 'measure',
+     'url': 'https://wbsapi.withings.net/measure',
+     'action': 'getmeas', 'dates': 'epoch', 'window': 90,
+     'records': 'measuregrps', 'key': ['grpid'],
+     'date_key': 'date', 'lastupdate': True},
+    {'name': 'intraday',
+     'url': 'https://wbsapi.withings.net/v2/measure',
+     'action': 'getintradayactivity', 'dates': 'epoch', 'window': 1,
+     'records': 'series', 'key': None,
+     'date_key': None, 'lastupdate': False},
+    {'name': 'sleep',
+     'url': 'https://wbsapi.withings.net/v2/sleep',
+     'action': 'get', 'dates': 'epoch', 'window': 1,
+     'records': 'series', 'key': ['startdate', 'enddate'],
+     'date_key': 'startdate', 'lastupdate': False},
+    {'name': 'sleep_summary',
+     'url': 'https://wbsapi.withings.net/v2/sleep',
+     'action': 'getsummary', 'dates': 'ymd', 'window': 90,
+     'records': 'series', 'key': ['date'],
+     'date_key': 'date', 'lastupdate': True},
+    {'name': 'workouts',
+     'url': 'https://wbsapi.withings.net/v2/measure',
+     'action': 'getworkouts', 'dates': 'ymd', 'window': 90,
+     'records': 'series', 'key': ['startdate', 'enddate'],
+     'date_key': 'startdate', 'lastupdate': True},
+]
+
+# Where the records of each endpoint are in its body
+RECORDS_KEYS = {endpoint['name']: endpoint['records']
+                for endpoint in NOKIA_ENDPOINTS}
+
+# Files of the single and partitioned layouts (see NOKIA_FILE_LAYOUT). Data
+# files take the extension of NOKIA_FILE_FORMAT.
+NOKIA_FILENAME = 'nokiahealthdata'
+MANIFEST_FILENAME = 'nokiahealthdata-manifest.json'
+PARTITION_TAG = 'nokiahealthdata-partition'
+MANIFEST_TAG = 'nokiahealthdata-manifest'
+
+# Seconds a member's sync holds its lease, after which a crashed worker's
+# lease lapses
+SYNC_LEASE_TTL = 60 * 60
+
+# Delete the lease only if it still holds this sync's token
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+# Extend the lease only if it still holds this sync's token
+RENEW_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("EXPIRE", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Times a fetch task waits out the rate limit and resumes before the sync
+# uploads what it has and requeues itself
+RATE_LIMIT_RETRIES = 20
+
+# Results handed from the fetch tasks of a sync to its upload task
+stage_store = stages.StageStore(rr.redis)
+
 
 @shared_task
-def process_nokia(oh_id):
+def process_nokia(oh_id, concurrent=False):
     '''
-    Fetch all nokia health data for a given user
+    Fetch all nokia health data for a given user, as a pipeline of tasks: a
+    fetch_nokia_endpoint per endpoint, then upload_nokia. With concurrent,
+    the endpoints are fetched at the same time, which suits interactive
+    syncs; otherwise one after another. Only one sync runs per member:
+    asking for another while one runs queues a single extra sync once it's
+    done.
     '''
     print('Entering process_nokia function')
+    token = acquire_sync_lease(oh_id, concurrent)
+    if token is None:
+        print('sync already running for {}, running again after it'.format(
+            oh_id))
+        return
+    try:
+        try:
+            start_cursors(oh_id)
+        except RequestsRespectfulRateLimitedError as e:
+            print('Hit limit starting sync for {}, requeueing'.format(oh_id))
+            finish_sync(oh_id, token, int(math.ceil(e.retry_after)),
+                        concurrent)
+            return
+        stop_time = datetime.now(timezone.utc)
+        print('processing until {} for member {}'.format(stop_time, oh_id))
+        run_id = uuid.uuid4().hex
+        fetches = [fetch_nokia_endpoint.si(oh_id, run_id, endpoint['name'],
+                                           stop_time.timestamp(), token)
+                   for endpoint in NOKIA_ENDPOINTS]
+        upload = upload_nokia.si(oh_id, run_id, token, concurrent)
+        if concurrent:
+            pipeline = chord(fetches, upload)
+        else:
+            pipeline = chain(*(fetches + [upload]))
+        pipeline.link_error(sync_failed.s(oh_id, run_id, token))
+        pipeline.delay()
+    except Exception:
+        finish_sync(oh_id, token)
+        raise
+
+
+@shared_task(bind=True, max_retries=RATE_LIMIT_RETRIES)
+def fetch_nokia_endpoint(self, oh_id, run_id, name, stop_time, token):
+    """
+    Fetch an endpoint's new records up to stop_time, stashing each page for
+    upload_nokia as it arrives, then the cursor they move on to. Running
+    into the rate limit checkpoints the cursor and retries once the limit
+    clears, resuming at the refused request. Out of retries, it stashes
+    when to try again instead.
+    """
+    nokia_member = OpenHumansMember.objects.get(oh_id=oh_id).nokia_member
+    endpoint = [endpoint for endpoint in NOKIA_ENDPOINTS
+                if endpoint['name'] == name][0]
+    cursor = nokia_member.sync_cursors.get(endpoint=name)
+    checkpoint = stage_store.get(run_id, name)
+    if checkpoint is not None:
+        print('resuming {} for {}'.format(name, oh_id))
+        load_cursor_state(cursor, checkpoint['cursor'])
+    retry_after = None
+    try:
+        sync_endpoint(endpoint, cursor, nokia_member.userid,
+                      nokia_member.access_token,
+                      datetime.fromtimestamp(stop_time, timezone.utc),
+                      lambda page: stage_store.append(run_id, name, page))
+    except RequestsRespectfulRateLimitedError as e:
+        print('Hit limit fetching {} for {}'.format(name, oh_id))
+        retry_after = e.retry_after
+    stage_store.put(run_id, name, {
+        'cursor': cursor_state(cursor),
+        'retry_after': retry_after,
+    })
+    if retry_after is not None and self.request.retries < self.max_retries:
+        renew_sync_lease(oh_id, token)
+        raise self.retry(countdown=int(math.ceil(retry_after)))
+
+
+@shared_task
+def upload_nokia(oh_id, run_id, token, concurrent=False):
+    """
+    Merge the records stashed by the fetch tasks into the member's data and
+    upload it, ending the sync.
+    """
+    countdown = None
+    try:
+        countdown = store_nokia(oh_id, run_id)
+    finally:
+        stage_store.delete(run_id, RECORDS_KEYS)
+        finish_sync(oh_id, token, countdown, concurrent)
+
+
+@shared_task
+def sync_failed(request, exc, traceback, oh_id, run_id, token):
+    """
+    Clean up after a task of a sync failed, so the member can sync again.
+    """
+    print('sync failed for {}: {!r}'.format(oh_id, exc))
+    stage_store.delete(run_id, RECORDS_KEYS)
+    finish_sync(oh_id, token)
+
+
+def finish_sync(oh_id, token, countdown=None, concurrent=False):
+    """
+    Release the member's sync lease, then sync again if that was asked for
+    meanwhile. Given a countdown, the rate limit stopped the sync: it runs
+    again once that has passed, concurrently if either it or the sync asked
+    for meanwhile was.
+    """
+    rerun = release_sync_lease(oh_id, token)
+    if countdown is not None:
+        process_nokia.apply_async(
+            args=[oh_id], kwargs={'concurrent': concurrent or bool(rerun)},
+            countdown=countdown)
+    elif rerun is not None:
+        process_nokia.delay(oh_id, concurrent=rerun)
+
+
+def acquire_sync_lease(oh_id, concurrent):
+    """
+    Take the member's sync lease, returning its token. If another sync holds
+    it, flag that the member should be synced again after it instead and
+    return None; a concurrent request makes the extra sync concurrent.
+    """
+    token = uuid.uuid4().hex
+    lease_key = 'nokia:sync:{}'.format(oh_id)
+    if rr.redis.set(lease_key, token, nx=True, ex=SYNC_LEASE_TTL):
+        return token
+    rerun = 'concurrent' if concurrent else 'background'
+    rr.redis.set(lease_key + ':rerun', rerun, nx=not concurrent,
+                 ex=SYNC_LEASE_TTL)
+    return None
+
+
+def renew_sync_lease(oh_id, token):
+    """
+    Give the member's sync lease a fresh TTL, if it's still ours.
+    """
+    lease_key = 'nokia:sync:{}'.format(oh_id)
+    rr.redis.register_script(RENEW_SCRIPT)(keys=[lease_key],
+                                           args=[token, SYNC_LEASE_TTL])
+
+
+def release_sync_lease(oh_id, token):
+    """
+    Release the member's sync lease if it's still ours. Returns whether to
+    sync again concurrently, or None if nobody asked for another sync.
+    """
+    lease_key = 'nokia:sync:{}'.format(oh_id)
+    rr.redis.register_script(RELEASE_SCRIPT)(keys=[lease_key], args=[token])
+    # Released first, so a request flagged after this check finds the lease
+    # free and runs itself
+    pipeline = rr.redis.pipeline()
+    pipeline.get(lease_key + ':rerun')
+    pipeline.delete(lease_key + ':rerun')
+    rerun = pipeline.execute()[0]
+    if rerun is None:
+        return None
+    return rerun == b'concurrent'
+
+
+def start_cursors(oh_id):
+    """
+    Give every endpoint of a member a sync cursor. Endpoints without one yet
+    start where their existing data ends, or when the member joined
+    Withings.
+    """
     oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
+    nokia_member = oh_member.nokia_member
+    cursors = set(nokia_member.sync_cursors.values_list('endpoint',
+                                                        flat=True))
+    missing = [endpoint for endpoint in NOKIA_ENDPOINTS
+               if endpoint['name'] not in cursors]
+    if not missing:
+        return
     oh_access_token = oh_member.get_access_token(
                             client_id=settings.OPENHUMANS_CLIENT_ID,
                             client_secret=settings.OPENHUMANS_CLIENT_SECRET)
-
     nokia_data = get_existing_nokia(oh_access_token)
-    nokia_member = oh_member.nokia_member
-    userid = nokia_member.userid
-    nokia_access_token = nokia_member.access_token
-
-    update_nokia(oh_member, userid, nokia_data, nokia_access_token)
+    try:
+        member_since = None
+        for endpoint in missing:
+            start_time = get_start_time(nokia_data, endpoint)
+            if start_time is None:
+                if member_since is None:
+                    member_since = get_member_since(
+                        nokia_member.access_token, nokia_member.userid)
+                start_time = member_since
+            NokiaSyncCursor.objects.create(
+                member=nokia_member, endpoint=endpoint['name'],
+                synced_until=start_time.replace(hour=0, minute=0, second=0,
+                                                microsecond=0))
+    finally:
+        nokia_data.close()
 
 
-def update_nokia(oh_member, userid, nokia_data, access_token):
+def store_nokia(oh_id, run_id):
+    """
+    Merge what the fetch tasks of a sync stashed into the member's data,
+    upload it and move the cursors on. If any endpoint ran out of retries
+    on the rate limit, returns the seconds until it clears, after which the
+    sync should run again; otherwise None.
+    """
+    oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
     oh_access_token = oh_member.get_access_token(
                             client_id=settings.OPENHUMANS_CLIENT_ID,
                             client_secret=settings.OPENHUMANS_CLIENT_SECRET)
+    nokia_member = oh_member.nokia_member
+    fetched = {}
+    for endpoint in NOKIA_ENDPOINTS:
+        stage = stage_store.get(run_id, endpoint['name'])
+        if stage is not None:
+            fetched[endpoint['name']] = stage
 
+    nokia_data = get_existing_nokia(oh_access_token)
+    touched_months = {}
     try:
-        # Set start date and end date for data fetch
-        start_time = get_start_time(oh_access_token, nokia_data, access_token)
-        start_ymd = start_time.strftime('%Y-%m-%d')
-
-        start_epoch = start_time.strftime('%s')
-        stop_time = datetime.utcnow() + timedelta(days=7)
-        stop_ymd = stop_time.strftime('%Y-%m-%d')
-        stop_epoch = stop_time.strftime('%s')
-
-        print('processing {} - {} for member {}'.format(start_ymd,
-                                                        stop_ymd,
-                                                        oh_member.oh_id))
-        nokia_urls = [
-            {'name': 'activity',
-             'url': 'https://wbsapi.withings.net/v2/' +
-                    'measure?action=getactivity&userid=' + str(userid) +
-                    '&startdateymd=' + str(start_ymd) +
-                    '&enddateymd=' + str(stop_ymd) +
-                    '&access_token=' + str(access_token)},
-            {'name': 'measure',
-             'url': 'https://wbsapi.withings.net' +
-                    '/measure?action=getmeas&userid=' + str(userid) +
-                    '&startdate=' + str(start_epoch) +
-                    '&enddate=' + str(stop_epoch) +
-                    '&access_token=' + str(access_token)},
-            {'name': 'intraday',
-             'url': 'https://wbsapi.withings.net' +
-                    '/v2/measure?action=getintradayactivity' +
-                    str(userid) + '&startdate=' + str(start_epoch) +
-                    '&enddate=' + str(stop_epoch) +
-                    '&access_token=' + str(access_token)},
-            {'name': 'sleep',
-             'url': 'https://wbsapi.withings.net/v2/sleep?' +
-                    'action=get&startdate=' + str(start_epoch) +
-                    '&enddate=' + str(stop_epoch) + '&userid=' +
-                    str(userid) +
-                    '&access_token=' + str(access_token)},
-            {'name': 'sleep_summary',
-             'url': 'https://wbsapi.withings.net' +
-                    '/v2/sleep?action=getsummary&startdateymd=' +
-                    str(start_ymd) + '&enddateymd=' + str(stop_ymd) +
-                    '&access_token=' + str(access_token)},
-            {'name': 'workouts',
-             'url': 'https://wbsapi.withings.net' +
-                    '/v2/measure?action=getworkouts&userid=' +
-                    str(userid) + '&startdateymd=' + str(start_ymd) +
-                    '&enddateymd=' + str(stop_ymd) +
-                    '&access_token=' + str(access_token)}
-        ]
-        for i in range(0, len(nokia_urls)):
-            endpoint = nokia_urls[i]
-            keyname = endpoint['name']
-            print('url for {}'.format(keyname))
-            print(endpoint['url'])
-            thisfetch = rr.get(url=endpoint['url'], realms=["Nokia"])
-            # print(thisfetch.text)
-            if keyname in nokia_data.keys():
-                print("Adding to existing")
-                # If this data type already exists, append to it.
-                # print(nokia_data[keyname])
-                print(type(nokia_data[keyname]))
-
-                if keyname == "activity":
-                    existing_entries = nokia_data[keyname]["body"]["activities"]
-                    new_entries = thisfetch.json()["body"]["activities"]
-                    merged = existing_entries + new_entries
-                    nokia_data[keyname]["body"]["activities"] = merged
-                elif keyname == "measure":
-                    existing_entries = nokia_data[keyname]["body"]["measuregrps"]
-                    new_entries = thisfetch.json()["body"]["measuregrps"]
-                    merged = existing_entries + new_entries
-                    nokia_data[keyname]["body"]["measuregrps"] = merged
-                elif keyname == "sleep" or keyname == "sleep_summary" or keyname == "workouts":
-                    existing_entries = nokia_data[keyname]["body"]["series"]
-                    new_entries = thisfetch.json()["body"]["series"]
-                    merged = existing_entries + new_entries
-                    nokia_data[keyname]["body"]["series"] = merged
-                    # intraday case not implemented yet
-            else:
-                print("Creating new endpoint array for {}".format(keyname))
-                # If this data type does not exist, create the key.
-                nokia_data[keyname] = thisfetch.json()
-        print("start_ymd: {} stop_ymd: {}".format(start_ymd, stop_ymd))
-        start_time = stop_time + timedelta(days=1)
-        start_ymd = start_time.strftime('%Y-%m-%d')
-        start_epoch = start_time.strftime('%s')
-        stop_time = stop_time + timedelta(days=8)
-        stop_ymd = stop_time.strftime('%Y-%m-%d')
-        stop_epoch = stop_time.strftime('%s')
-        print("start_ymd: {} stop_ymd: {}".format(start_ymd, stop_ymd))
-
-    except RequestsRespectfulRateLimitedError:
+        for endpoint in NOKIA_ENDPOINTS:
+            if endpoint['name'] not in fetched:
+                continue
+            # Sections without new records are written out without parsing
+            if endpoint['name'] in nokia_data and \
+                    not stage_store.has_items(run_id, endpoint['name']):
+                continue
+            touched_months[endpoint['name']] = merge_section(
+                nokia_data, endpoint,
+                stage_store.items(run_id, endpoint['name']))
+        replace_nokia(oh_member, nokia_data, touched_months)
+    finally:
+        nokia_data.close()
+    # Only move the cursors on once the data they cover is uploaded
+    for cursor in nokia_member.sync_cursors.all():
+        if cursor.endpoint in fetched:
+            load_cursor_state(cursor, fetched[cursor.endpoint]['cursor'])
+            cursor.save()
+
+    retry_after = [stage['retry_after'] for stage in fetched.values()
+                   if stage['retry_after'] is not None]
+    if retry_after:
         print('Hit limit requeue request')
+        countdown = int(math.ceil(max(retry_after)))
         logger.debug(
-            'Requeued processing for {} with 60s delay'.format(
-                oh_member.oh_id)
+            'Requeued processing for {} with {}s delay'.format(
+                oh_id, countdown)
         )
-        process_nokia.apply_async(args=[oh_member.oh_id], countdown=61)
-    finally:
-        replace_nokia(oh_member, nokia_data)
+        return countdown
+    nokia_member.last_updated = datetime.now(timezone.utc)
+    nokia_member.save(update_fields=['last_updated'])
+    return None
+
+
+def merge_section(nokia_data, endpoint, pages):
+    """
+    Merge the pages of an endpoint fetched by a sync into nokia_data, in the
+    order they came. Only the new records are held in memory: the existing
+    ones, kept sorted by earlier syncs, are read from the file as the section
+    is written and merged in by date. Returns the months of the records
+    merged.
+    """
+    name = endpoint['name']
+    records_key = endpoint['records']
+    existing = None
+    if name not in nokia_data:
+        print("Creating new endpoint array for {}".format(name))
+        section = {'status': 0, 'body': {}}
+    elif not nokia_data.is_parsed(name):
+        section, existing, _ = nokia_data.split_section(name, records_key,
+                                                        placeholder=True)
+    else:
+        section = nokia_data[name]
+        existing = section.get('body', {}).get(records_key)
+        if isinstance(existing, dict):
+            existing = existing.items()
+    body = section.setdefault('body', {})
+    merger = merge.merger_for(endpoint, None)
+    for page in pages:
+        merge_page(body, merger, endpoint, page)
+    records = merger.merged_with(existing or ())
+    if endpoint['key'] is None:
+        records = storage.Series(records)
+    body[records_key] = records
+    nokia_data[name] = section
+    return merger.touched_months
 
 
-def replace_nokia(oh_member, nokia_data):
+def cursor_state(cursor):
     """
-    Delete any old file and upload new
+    The position of a sync cursor, as handed between tasks.
     """
+    return {
+        'synced_until': cursor.synced_until.timestamp(),
+        'window_end': (cursor.window_end.timestamp()
+                       if cursor.window_end else None),
+        'offset': cursor.offset,
+        'updatetime': cursor.updatetime,
+    }
+
+
+def load_cursor_state(cursor, state):
+    cursor.synced_until = datetime.fromtimestamp(state['synced_until'],
+                                                 timezone.utc)
+    cursor.window_end = (
+        datetime.fromtimestamp(state['window_end'], timezone.utc)
+        if state['window_end'] is not None else None)
+    cursor.offset = state['offset']
+    cursor.updatetime = state['updatetime']
+
+
+def estimate_requests(cursors, last_updated, now):
+    """
+    Roughly how many requests syncing a member up to now takes, given its
+    sync cursors by endpoint: a page per time window left to fetch, or one
+    for endpoints asking for what changed since their previous sync.
+    Endpoints without a cursor are counted from when the member was last
+    updated, plus one request to find where they start.
+    """
+    requests = 0
+    for endpoint in NOKIA_ENDPOINTS:
+        cursor = cursors.get(endpoint['name'])
+        if cursor is None:
+            requests += 1
+            synced_until = last_updated
+        elif endpoint['lastupdate'] and cursor.updatetime is not None:
+            requests += 1
+            continue
+        else:
+            synced_until = cursor.synced_until
+        days = max((now - synced_until).total_seconds() / 86400, 0)
+        requests += max(int(math.ceil(days / endpoint['window'])), 1)
+    return requests
+
+
+def sync_endpoint(endpoint, cursor, userid, access_token, stop_time,
+                  stash):
+    """
+    Fetch an endpoint from its cursor up to stop_time, one bounded time
+    window and one page at a time. Each page body with records is handed to
+    stash as it arrives and the cursor moved past it, so a rate-limited
+    backfill resumes where it stopped. Once backfilled, endpoints supporting
+    lastupdate only ask for what changed since the previous sync.
+    """
+    realms = nokia_realms(userid, endpoint['name'])
+    if endpoint['lastupdate'] and cursor.updatetime is not None:
+        sync_endpoint_updates(endpoint, cursor, stash, realms, userid,
+                              access_token, stop_time)
+    else:
+        sync_endpoint_windows(endpoint, cursor, stash, realms, userid,
+                              access_token, stop_time)
+
+
+def sync_endpoint_windows(endpoint, cursor, stash, realms, userid,
+                          access_token, stop_time):
+    """
+    Fetch an endpoint's records one date window at a time.
+    """
+    while cursor.synced_until < stop_time:
+        start = cursor.synced_until
+        end = cursor.window_end or min(
+            start + timedelta(days=endpoint['window']), stop_time)
+        print('fetching {} from {} to {} at offset {}'.format(
+            endpoint['name'], start, end, cursor.offset))
+        params = endpoint_params(endpoint, start, end, cursor.offset)
+        params.update({'userid': userid, 'access_token': access_token})
+        page = withings.response_data(
+            rr.get(url=endpoint['url'], params=params, realms=realms))
+        if page['body'].get(endpoint['records']):
+            stash(page['body'])
+        if page['body'].get('more'):
+            cursor.window_end = end
+            cursor.offset = page['body']['offset']
+        else:
+            cursor.synced_until = end
+            cursor.window_end = None
+            cursor.offset = 0
+    # Fetch the day in progress again next time
+    cursor.synced_until = min(cursor.synced_until, stop_time.replace(
+        hour=0, minute=0, second=0, microsecond=0))
+    if endpoint['lastupdate']:
+        cursor.updatetime = calendar.timegm(stop_time.utctimetuple())
+
+
+def sync_endpoint_updates(endpoint, cursor, stash, realms, userid,
+                          access_token, stop_time):
+    """
+    Fetch the records of an endpoint created or changed since the cursor's
+    updatetime, including measures backdated by a late device sync.
+    """
+    while True:
+        print('fetching {} updated since {} at offset {}'.format(
+            endpoint['name'], cursor.updatetime, cursor.offset))
+        params = {'action': endpoint['action'],
+                  'lastupdate': cursor.updatetime,
+                  'userid': userid, 'access_token': access_token}
+        if cursor.offset:
+            params['offset'] = cursor.offset
+        page = withings.response_data(
+            rr.get(url=endpoint['url'], params=params, realms=realms))
+        if page['body'].get(endpoint['records']):
+            stash(page['body'])
+        if not page['body'].get('more'):
+            break
+        cursor.offset = page['body']['offset']
+    cursor.offset = 0
+    cursor.updatetime = calendar.timegm(stop_time.utctimetuple())
+    cursor.synced_until = stop_time.replace(hour=0, minute=0, second=0,
+                                            microsecond=0)
+
+
+def endpoint_params(endpoint, start, end, offset=0):
+    """
+    Query parameters asking an endpoint for the window [start, end).
+    """
+    params = {'action': endpoint['action']}
+    if endpoint['dates'] == 'ymd':
+        # Days are inclusive on both ends
+        params['startdateymd'] = start.strftime('%Y-%m-%d')
+        params['enddateymd'] = (end - timedelta(seconds=1)).strftime(
+            '%Y-%m-%d')
+    else:
+        params['startdate'] = calendar.timegm(start.utctimetuple())
+        params['enddate'] = calendar.timegm(end.utctimetuple())
+    if offset:
+        params['offset'] = offset
+    return params
+
+
+def merge_page(body, merger, endpoint, page_body):
+    """
+    Merge one page of an endpoint's records, replacing records already
+    fetched with the same key. Other body fields take the page's values,
+    unless it brings no records: fields like getmeas' updatetime change on
+    every request, and would otherwise make unchanged data look new.
+    """
+    page_body = dict(page_body)
+    new_entries = page_body.pop(endpoint['records'], None)
+    if not new_entries:
+        return
+    page_body.pop('more', None)
+    page_body.pop('offset', None)
+    body.update(page_body)
+    merger.merge(new_entries)
+
+
+def replace_nokia(oh_member, nokia_data, touched_months):
+    """
+    Delete any old file and upload new, unless its content is unchanged
+    """
+    if settings.NOKIA_FILE_LAYOUT == 'partitioned':
+        replace_nokia_partitions(oh_member, nokia_data, touched_months)
+        return
+    file_format = settings.NOKIA_FILE_FORMAT
     tmp_directory = tempfile.mkdtemp()
     metadata = {
-        'tags': ['nokiahealthdata', 'health', 'measure'],
+        'tags': ['nokiahealthdata', 'health', 'measure', file_format],
         'description': 'File with Nokia Health data',
+        'format': file_format,
         'updated_at': str(datetime.utcnow()),
     }
-    filename = 'nokiahealthdata.json'
-    out_file = os.path.join(tmp_directory, filename)
-    logger.debug('deleted old file for {}'.format(oh_member.oh_id))
-    api.delete_file(oh_member.access_token,
-                    oh_member.oh_id,
-                    file_basename=filename)
-    with open(out_file, 'w') as json_file:
-        json.dump(nokia_data, json_file)
-        json_file.flush()
+    out_file = os.path.join(
+        tmp_directory, NOKIA_FILENAME + storage.FILE_FORMATS[file_format])
+    try:
+        metadata['sha256'] = storage.write_file(out_file, nokia_data,
+                                                file_format, RECORDS_KEYS)
+        if unchanged(out_file, metadata, nokia_data.basename,
+                     nokia_data.metadata):
+            print('data unchanged for {}'.format(oh_member.oh_id))
+            return
+        # The data may have been uploaded in another format before
+        upload_nokia_file(oh_member, out_file, metadata,
+                          replaces=[nokia_data.basename])
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+def replace_nokia_partitions(oh_member, nokia_data, touched_months):
+    """
+    Merge the months touched by this sync into their partition files and
+    re-upload the ones that changed, then the manifest listing every
+    partition. When there is no manifest yet, all of nokia_data is the
+    member's single nokiahealthdata file, which is split into partitions and
+    removed.
+    """
+    oh_access_token = oh_member.get_access_token(
+                            client_id=settings.OPENHUMANS_CLIENT_ID,
+                            client_secret=settings.OPENHUMANS_CLIENT_SECRET)
+    files = {dfile['basename']: dfile for dfile in
+             api.exchange_oauth2_member(oh_access_token)['data']}
+    splitting = MANIFEST_FILENAME not in files
+    if splitting:
+        manifest = {'layout': 'partitioned', 'partitions': {}}
+    else:
+        manifest = storage.download_json(
+            files[MANIFEST_FILENAME]['download_url'])
+    file_format = settings.NOKIA_FILE_FORMAT
+    uploaded = False
+    tmp_directory = tempfile.mkdtemp()
+    try:
+        for endpoint in NOKIA_ENDPOINTS:
+            name = endpoint['name']
+            if name not in nokia_data:
+                continue
+            section = nokia_data[name]
+            body = dict(section.get('body', {}))
+            records = body.pop(endpoint['records'], None)
+            if isinstance(records, storage.Series):
+                records = records.pairs
+            elif records is not None:
+                # Sections this sync left alone may predate sorted files
+                records = merge.merger_for(endpoint, records).sorted_records()
+            for month, records in merge.group_by_month(endpoint, records):
+                if not splitting and \
+                        month not in touched_months.get(name, ()):
+                    continue
+                existing = [partition_filename(name, month, other_format)
+                            for other_format in storage.FILE_FORMATS]
+                existing = [filename for filename in existing
+                            if filename in files]
+                partition = {'status': section.get('status', 0), 'body': {}}
+                if existing:
+                    partition_data = storage.NokiaFile.download(
+                        files[existing[0]]['download_url'], existing[0])
+                    try:
+                        partition = partition_data[name]
+                    finally:
+                        partition_data.close()
+                partition_body = partition.setdefault('body', {})
+                merger = merge.merger_for(
+                    endpoint, partition_body.get(endpoint['records']))
+                merger.merge(records)
+                partition_body.update(body)
+                partition_body[endpoint['records']] = merger.sorted_records()
+                filename = partition_filename(name, month, file_format)
+                out_file = os.path.join(tmp_directory, filename)
+                metadata = {
+                    'tags': [PARTITION_TAG, 'health', name, month,
+                             file_format],
+                    'description': 'Nokia Health {} data for {}'.format(
+                        name, month),
+                    'format': file_format,
+                    'sha256': storage.write_file(
+                        out_file, {name: partition}, file_format,
+                        RECORDS_KEYS),
+                    'updated_at': str(datetime.utcnow()),
+                }
+                if existing and unchanged(out_file, metadata, existing[0],
+                                          files[existing[0]]['metadata']):
+                    os.remove(out_file)
+                else:
+                    upload_nokia_file(oh_member, out_file, metadata,
+                                      replaces=existing)
+                    uploaded = True
+                manifest['partitions'].setdefault(name, {})[month] = {
+                    'filename': filename,
+                    'format': file_format,
+                    'records': len(partition_body[endpoint['records']]),
+                }
+        if not uploaded and not splitting:
+            print('data unchanged for {}'.format(oh_member.oh_id))
+            return
+        manifest['updated_at'] = str(datetime.utcnow())
+        metadata = {
+            'tags': [MANIFEST_TAG, 'health', 'measure'],
+            'description': 'Index of the partitioned Nokia Health data files',
+            'updated_at': manifest['updated_at'],
+        }
+        out_file = os.path.join(tmp_directory, MANIFEST_FILENAME)
+        with open(out_file, 'w') as json_file:
+            json.dump(manifest, json_file)
+        upload_nokia_file(oh_member, out_file, metadata)
+        if splitting and nokia_data.basename:
+            api.delete_file(oh_member.access_token,
+                            oh_member.oh_id,
+                            file_basename=nokia_data.basename)
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+
+
+def upload_nokia_file(oh_member, out_file, metadata, replaces=()):
+    """
+    Upload out_file in place of the member's file of the same name, and of
+    any files named in replaces.
+    """
+    filename = os.path.basename(out_file)
+    for basename in [filename] + [basename for basename in replaces
+                                  if basename and basename != filename]:
+        api.delete_file(oh_member.access_token,
+                        oh_member.oh_id,
+                        file_basename=basename)
     api.upload_aws(out_file, metadata,
                    oh_member.access_token,
                    project_member_id=oh_member.oh_id)
-    logger.debug('uploaded new file for {}'.format(oh_member.oh_id))
+    os.remove(out_file)
+    logger.debug('uploaded {} for {}'.format(filename, oh_member.oh_id))
+
+
+def unchanged(out_file, metadata, basename, previous_metadata):
+    """
+    Whether out_file has the content already uploaded as basename, going by
+    the content hashes in their metadata.
+    """
+    return basename == os.path.basename(out_file) and \
+        previous_metadata.get('sha256') == metadata['sha256']
+
+
+def partition_filename(endpoint_name, month, file_format):
+    return 'nokiahealthdata-{}-{}{}'.format(
+        endpoint_name, month, storage.FILE_FORMATS[file_format])
 
 
 def get_existing_nokia(oh_access_token):
+    """
+    Download the member's existing data to disk. Its endpoint sections are
+    only parsed once a sync needs them. Close the result when done.
+    Partitioned data is merged at upload time instead, so once the member
+    has a manifest the sync starts out empty.
+    """
     print("Entering get_existing_nokia function...")
     member = api.exchange_oauth2_member(oh_access_token)
+    if settings.NOKIA_FILE_LAYOUT == 'partitioned' and any(
+            MANIFEST_TAG in dfile['metadata']['tags']
+            for dfile in member['data']):
+        print('found partitioned data')
+        return storage.NokiaFile()
     for dfile in member['data']:
         if 'nokiahealthdata' in dfile['metadata']['tags']:
             print("Found file with tag...")
-            # get file here and read the json into memory
-            tf_in = tempfile.NamedTemporaryFile(suffix='.json')
-            tf_in.write(requests.get(dfile['download_url']).content)
-            tf_in.flush()
-            nokia_data = json.load(open(tf_in.name))
-            # print("getting existing data:")
-            # print(nokia_data)
-            # print(type(nokia_data))
-            # for key in nokia_data:
-            #     print(key)
-            return nokia_data
+            return storage.NokiaFile.download(dfile['download_url'],
+                                              dfile['basename'],
+                                              dfile['metadata'])
     print('no existing data with nokiahealthdata tag')
-    return {}
+    return storage.NokiaFile()
 
 
-def get_start_time(oh_access_token, nokia_data, access_token):
+def nokia_realms(userid, endpoint=None):
     """
-    Look at existing nokia data and find out the last date it was fetched
-    for. Start by looking at activity and then measure endpoints.
+    Rate limit realms for calls made on behalf of a Withings user. These nest
+    under the application-wide "Nokia" realm; intraday has its own budget.
     """
+    realm = 'Nokia:user:{}'.format(userid)
+    if endpoint == 'intraday':
+        realm += ':intraday'
+    return [realm]
 
-    if nokia_data != {}:
-        print("detected existing nokia data")
-        # If there is existing data, start from the most recent date.
-        try:
-            # If there is activity data, check whether it has a date
-            activity_data = nokia_data["activity"]
-            print("found activity data")
-
-            date_ymd = activity_data["body"]["activities"][-1]["date"]
-            print("found activity date")
-            date_parsed = dp.parse(date_ymd)
-            print("parsed date")
-
-            print("setting start date {} from existing activity data".format(date_parsed))
-            return date_parsed
-        except:
-            print("Couldn't get date from activity... trying with measure")
-            try:
-                # If there is measure data, check whether it has a date
-                measure_data = nokia_data["measure"]
-
-                date_epoch = measure_data["body"]["updatetime"]
-                date_struct = time.localtime(date_epoch)
-                date_parsed = datetime.datetime(*date_struct[:3])
-
-                print("setting start date {} from existing measure data".format(date_parsed))
-                return date_parsed
-            except:
-                print("Couldn't get date from measure... using member since")
-
-    infourl = 'https://wbsapi.withings.net/user?action=getinfo&access_token=' + str(access_token)
-    userinfo = rr.get(url=infourl, realms=["Nokia"])
-    userinfo = userinfo.text
-    userinfo = ast.literal_eval(userinfo)
-    print("userinfo: {}".format(userinfo))
-    userinfobody = userinfo["body"]
-    print("userinfobody: {}".format(userinfobody))
-    userinfobodyuser = userinfobody["user"]
-    print("userinfobodyuser: {}".format(userinfobodyuser))
-    member_since = userinfobodyuser["created"]
-    print("member_since: {}".format(member_since))
-    member_since_struct = time.localtime(member_since)
-    print("member_since_struct: {}".format(member_since_struct))
-    member_since_parsed = datetime(*member_since_struct[:3])
-    print("member_since_parsed: {}".format(member_since_parsed))
 
-    return member_since_parsed
+def get_start_time(nokia_data, endpoint):
+    """
+    Find when the existing data of an endpoint ends, to start its cursor
+    there. Returns None when there are no dated records.
+    """
+    try:
+        records = nokia_data[endpoint['name']]['body'][endpoint['records']]
+    except (KeyError, TypeError):
+        return None
+    if isinstance(records, dict):
+        # Intraday series are keyed by timestamp
+        dates = [int(timestamp) for timestamp in records]
+    else:
+        dates = [record[endpoint['date_key']] for record in records
+                 if endpoint['date_key'] in record]
+    if not dates:
+        return None
+    # Epoch seconds and YYYY-MM-DD strings both sort chronologically
+    start_time = parse_record_time(max(dates))
+    print("setting {} start date {} from existing data".format(
+        endpoint['name'], start_time))
+    return start_time
+
+
+def parse_record_time(value):
+    """
+    Withings dates are either epoch seconds or YYYY-MM-DD strings.
+    """
+    if isinstance(value, (int, float)) or str(value).isdigit():
+        return datetime.fromtimestamp(int(value), timezone.utc)
+    return dp.parse(value).replace(tzinfo=timezone.utc)
+
+
+def get_member_since(access_token, userid):
+    """
+    When the member joined Withings, where a first backfill starts.
+    """
+    infourl = 'https://wbsapi.withings.net/user'
+    userinfo = withings.response_data(rr.get(
+        url=infourl,
+        params={'action': 'getinfo', 'access_token': access_token},
+        realms=nokia_realms(userid)))
+    member_since = userinfo["body"]["user"]["created"]
+    print("member_since: {}".format(member_since))
+    return datetime.fromtimestamp(member_since, timezone.utc)
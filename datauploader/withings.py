@@ -0,0 +1,40 @@
+"""
+Helpers for talking to the Withings API.
+"""
+
+# Withings answers throttled calls with HTTP 200 and one of these statuses in
+# the JSON body.
+THROTTLE_STATUSES = (601,)
+
+
+def is_throttled(response):
+    """
+    Tell whether Withings throttled this response. Throttle replies are tiny,
+    so larger bodies are not parsed.
+    """
+    if response.status_code == 429:
+        return True
+    if len(response.content) > 1024:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get('status') in THROTTLE_STATUSES
+
+
+class WithingsError(Exception):
+    """
+    Withings answered with a non-zero status.
+    """
+
+
+def response_data(response):
+    """
+    Return the decoded JSON of a successful Withings response.
+    """
+    data = response.json()
+    if data.get('status') != 0:
+        raise WithingsError('Withings returned status {}'.format(
+            data.get('status')))
+    return data
@@ -11,7 +11,8 @@ def get_nokia_file(oh_member):
                           client_secret=settings.OPENHUMANS_CLIENT_SECRET)
         user_object = api.exchange_oauth2_member(oh_access_token)
         for dfile in user_object['data']:
-            if 'nokiahealthdata' in dfile['metadata']['tags']:
+            tags = dfile['metadata']['tags']
+            if 'nokiahealthdata' in tags or 'nokiahealthdata-manifest' in tags:
                 return dfile['download_url']
         return ''
     except:
@@ -0,0 +1,75 @@
+import time
+
+import requests
+from django.core.management.base import BaseCommand
+from requests.adapters import BaseAdapter
+
+from nokia.settings import rr
+from requests_respectful import RespectfulRequester
+from requests_respectful.globals import config
+
+# Realm the benchmark's requests are counted in, unregistered afterwards
+REALM = 'LimiterBenchmark'
+URL = 'https://benchmark.invalid/'
+
+
+class CannedAdapter(BaseAdapter):
+    """
+    Answer every request with an empty 200, without touching the network.
+    """
+
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response.url = request.url
+        response._content = b'{}'
+        return response
+
+    def close(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Time the rate limiter's overhead per request"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests', type=int, default=2000,
+            help="Requests to time each way")
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        rr.register_realm(REALM, max_requests=2 * count +
+                          config['safety_threshold'] + 1, timespan=60)
+        session = rr.session(REALM)
+        session.mount(URL, CannedAdapter())
+        try:
+            proxied = rr._session_request_func([REALM], 'get', URL)
+            self.report('validate proxied request', count,
+                        lambda: RespectfulRequester._validate_request_func(
+                            proxied))
+            self.report('validate lambda', count,
+                        lambda: RespectfulRequester._validate_request_func(
+                            lambda: requests.get(URL)))
+            direct = self.report('session.get', count,
+                                 lambda: session.get(URL))
+            limited = self.report('rr.get', count,
+                                  lambda: rr.get(URL, realms=[REALM]))
+            self.stdout.write('limiter overhead: {:.1f} us/request'.format(
+                limited - direct))
+        finally:
+            rr.unregister_realm(REALM)
+            rr.configure_session(REALM)
+
+    def report(self, name, count, func):
+        """
+        Call func count times and print, then return, the microseconds per
+        call.
+        """
+        started_at = time.perf_counter()
+        for _ in range(count):
+            func()
+        per_call = (time.perf_counter() - started_at) / count * 1e6
+        self.stdout.write('{}: {:.1f} us/call'.format(name, per_call))
+        return per_call
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+from nokia.settings import rr
+
+
+class Command(BaseCommand):
+    help = 'Print rate limiter metrics in the Prometheus text format'
+
+    def handle(self, *args, **options):
+        self.stdout.write(rr.metrics_text(), ending='')
@@ -1,18 +1,75 @@
 from django.core.management.base import BaseCommand
-from main.models import NokiaHealthMember
+from django.db.models import Q
+from main.models import NokiaHealthMember, NokiaSyncCursor
 from main.views import process_nokia
-import arrow
-from datetime import timedelta
+from datauploader import celery_app
+from datauploader.tasks import estimate_requests
+from nokia.settings import rr
+from datetime import datetime, timedelta, timezone
+
+# Members read from the database at a time
+BATCH_SIZE = 500
+
+# Furthest ahead an update is scheduled, well within the broker's visibility
+# timeout so it isn't delivered twice. Members left over stay due for the
+# next run.
+SCHEDULE_HORIZON = \
+    celery_app.conf.broker_transport_options['visibility_timeout'] // 2
 
 
 class Command(BaseCommand):
     help = 'Update data for all users'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--share', type=float, default=0.8,
+            help="Share of the Withings rate limit to use, leaving the rest "
+                 "for updates started from the dashboard")
+
     def handle(self, *args, **options):
-        nokia_users = NokiaHealthMember.objects.all()
-        for user in nokia_users:
-            if user.last_updated < (arrow.now() - timedelta(days=4)):
-                print("running update for user {}".format(user.userid))
-                process_nokia.delay(user.user.oh_id)
-            else:
-                print("didn't update {}".format(user.userid))
+        # Stagger the updates, most out of date first, so the requests they
+        # are expected to make stay within the "Nokia" realm's budget rather
+        # than all hitting the rate limit and being requeued.
+        rate = options['share'] * rr.realm_max_requests("Nokia") / \
+            rr.realm_timespan("Nokia")
+        now = datetime.now(timezone.utc)
+        scheduled = 0
+        for batch in due_members(now - timedelta(days=4)):
+            if scheduled / rate > SCHEDULE_HORIZON:
+                break
+            cursors = {}
+            for cursor in NokiaSyncCursor.objects.filter(
+                    member_id__in=[userid for userid, _, _ in batch]):
+                cursors.setdefault(cursor.member_id, {})[cursor.endpoint] = \
+                    cursor
+            for userid, oh_id, last_updated in batch:
+                countdown = int(scheduled / rate)
+                if countdown > SCHEDULE_HORIZON:
+                    print("leaving the remaining members for the next run")
+                    break
+                print("running update for user {} in {}s".format(
+                    userid, countdown))
+                process_nokia.apply_async(args=[oh_id], countdown=countdown)
+                scheduled += estimate_requests(cursors.get(userid, {}),
+                                               last_updated, now)
+        print("scheduled about {} requests over {}s".format(
+            scheduled, int(scheduled / rate)))
+
+
+def due_members(updated_before):
+    """
+    Yield batches of (userid, oh_id, last_updated) of the members last
+    updated before updated_before, least recently updated first. Each batch
+    continues from where the previous one ended, on the last_updated index.
+    """
+    members = NokiaHealthMember.objects.filter(
+        last_updated__lt=updated_before).order_by('last_updated', 'userid')
+    batch = list(members.values_list(
+        'userid', 'user__oh_id', 'last_updated')[:BATCH_SIZE])
+    while batch:
+        yield batch
+        userid, _, last_updated = batch[-1]
+        batch = list(members.filter(
+            Q(last_updated__gt=last_updated) |
+            Q(last_updated=last_updated, userid__gt=userid)).values_list(
+                'userid', 'user__oh_id', 'last_updated')[:BATCH_SIZE])
@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_auto_20181010_1534'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NokiaSyncCursor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('endpoint', models.CharField(max_length=32)),
+                ('synced_until', models.DateTimeField()),
+                ('window_end', models.DateTimeField(null=True)),
+                ('offset', models.IntegerField(default=0)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_cursors', to='main.nokiahealthmember')),
+            ],
+            options={
+                'unique_together': {('member', 'endpoint')},
+            },
+        ),
+    ]
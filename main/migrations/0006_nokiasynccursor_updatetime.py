@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 10:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_nokiasynccursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nokiasynccursor',
+            name='updatetime',
+            field=models.IntegerField(null=True),
+        ),
+    ]
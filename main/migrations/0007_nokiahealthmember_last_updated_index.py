@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_nokiasynccursor_updatetime'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nokiahealthmember',
+            name='last_updated',
+            field=models.DateTimeField(db_index=True, default='2026-10-11 11:20:04+00:00'),
+        ),
+    ]
@@ -14,7 +14,8 @@ class NokiaHealthMember(models.Model):
     userid = models.CharField(max_length=16, primary_key=True, unique=True)
     deviceid = models.CharField(max_length=16)
     last_updated = models.DateTimeField(
-                            default=(arrow.now() - timedelta(days=7)).format())
+                            default=(arrow.now() - timedelta(days=7)).format(),
+                            db_index=True)
     last_submitted = models.DateTimeField(
                             default=(arrow.now() - timedelta(days=7)).format())
     # OAuth1
@@ -68,3 +69,21 @@ class NokiaHealthMember(models.Model):
             self.save()
             return True
         return False
+
+
+class NokiaSyncCursor(models.Model):
+    """
+    Progress of fetching one Withings endpoint for a member. Everything
+    before synced_until has been fetched; a window cut short by a rate limit
+    resumes at offset within the window ending at window_end. Endpoints
+    taking 'lastupdate' sync changes since updatetime once backfilled.
+    """
+    member = models.ForeignKey(NokiaHealthMember, related_name="sync_cursors", on_delete=models.CASCADE)
+    endpoint = models.CharField(max_length=32)
+    synced_until = models.DateTimeField()
+    window_end = models.DateTimeField(null=True)
+    offset = models.IntegerField(default=0)
+    updatetime = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = ('member', 'endpoint')
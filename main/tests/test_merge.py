@@ -0,0 +1,68 @@
+from django.test import SimpleTestCase
+
+from datauploader import merge
+
+
+class RecordMergerTestCase(SimpleTestCase):
+    """
+    Test merging pages of records into an endpoint's existing records.
+    """
+
+    def test_dedups_and_sorts(self):
+        merger = merge.RecordMerger(
+            [{'grpid': 1, 'date': 100, 'value': 'old'},
+             {'grpid': 2, 'date': 200, 'value': 'old'},
+             {'grpid': 2, 'date': 200, 'value': 'duplicate'}],
+            ['grpid'], 'date')
+        merger.merge([{'grpid': 3, 'date': 150, 'value': 'new'},
+                      {'grpid': 1, 'date': 100, 'value': 'new'}])
+        self.assertEqual(merger.sorted_records(), [
+            {'grpid': 1, 'date': 100, 'value': 'new'},
+            {'grpid': 3, 'date': 150, 'value': 'new'},
+            {'grpid': 2, 'date': 200, 'value': 'duplicate'},
+        ])
+        # Sorting again keeps the key index in step with the records
+        merger.merge([{'grpid': 3, 'date': 150, 'value': 'newer'}])
+        self.assertEqual(
+            [record['value'] for record in merger.sorted_records()],
+            ['new', 'newer', 'duplicate'])
+
+    def test_touched_months(self):
+        merger = merge.RecordMerger(
+            [{'date': '2018-01-31'}], ['date'], 'date')
+        self.assertEqual(merger.touched_months, set())
+        merger.merge([{'date': '2018-02-01'}, {'date': '2018-03-15'}])
+        self.assertEqual(merger.touched_months, {'2018-02', '2018-03'})
+
+    def test_series(self):
+        merger = merge.SeriesMerger({'200': {'steps': 1}})
+        merger.merge({'100': {'steps': 2}, '200': {'steps': 3}})
+        self.assertEqual(list(merger.sorted_records().items()),
+                         [('100', {'steps': 2}), ('200', {'steps': 3})])
+
+    def test_merged_with_existing(self):
+        merger = merge.RecordMerger(None, ['grpid'], 'date')
+        merger.merge([{'grpid': 3, 'date': 150, 'value': 'new'},
+                      {'grpid': 1, 'date': 100, 'value': 'new'}])
+        existing = iter([{'grpid': 1, 'date': 100, 'value': 'old'},
+                         {'grpid': 2, 'date': 200, 'value': 'old'}])
+        self.assertEqual(list(merger.merged_with(existing)), [
+            {'grpid': 1, 'date': 100, 'value': 'new'},
+            {'grpid': 3, 'date': 150, 'value': 'new'},
+            {'grpid': 2, 'date': 200, 'value': 'old'},
+        ])
+        merger = merge.SeriesMerger(None)
+        merger.merge({'1000': {'steps': 2}, '200': {'steps': 3}})
+        existing = iter([('200', {'steps': 1}), ('300', {'steps': 1})])
+        self.assertEqual(list(merger.merged_with(existing)), [
+            ('200', {'steps': 3}), ('300', {'steps': 1}),
+            ('1000', {'steps': 2})])
+
+    def test_group_by_month(self):
+        endpoint = {'key': ['date'], 'date_key': 'date'}
+        months = merge.group_by_month(endpoint, iter(
+            [{'date': '2018-01-31'}, {'date': '2018-02-01'},
+             {'date': '2018-02-15'}]))
+        self.assertEqual(next(months), ('2018-01', [{'date': '2018-01-31'}]))
+        self.assertEqual(list(months), [
+            ('2018-02', [{'date': '2018-02-01'}, {'date': '2018-02-15'}])])
@@ -0,0 +1,97 @@
+import functools
+from unittest import mock
+
+import fakeredis
+import requests
+from django.test import SimpleTestCase
+
+from requests_respectful import (RequestsRespectfulError,
+                                 RequestsRespectfulRateLimitedError,
+                                 RespectfulRequester)
+
+
+class RespectfulRequesterTestCase(SimpleTestCase):
+    """
+    Test the rate limiter's Lua scripts against an in-memory Redis, with a
+    clock that only moves when told to. The default safety threshold keeps
+    10 permits of every realm in reserve.
+    """
+
+    def setUp(self):
+        self.now = 1500000000000
+        redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        with mock.patch('requests_respectful.respectful_requester.redis',
+                        redis):
+            self.rr = RespectfulRequester()
+        self.rr._now_ms = lambda: self.now
+
+    def test_sliding_window(self):
+        self.rr.register_realm('Test', 13, 60)
+        for _ in range(3):
+            self.assertEqual(self.rr.reserve(['Test']), 0)
+            self.now += 1000
+        # The first permit frees up a minute after it was taken
+        self.assertEqual(self.rr.reserve(['Test']), 57)
+        self.assertEqual(self.rr.realm_occupancy('Test'), 3)
+        self.now += 57000
+        self.assertEqual(self.rr.reserve(['Test']), 0)
+        self.assertEqual(self.rr.realm_occupancy('Test'), 3)
+
+    def test_nested_template_realms(self):
+        self.rr.register_realms([('Test', 13, 60),
+                                 ('Test:user:*', 12, 60)])
+        self.rr.acquire(['Test:user:1'], n=2)
+        with self.assertRaises(RequestsRespectfulRateLimitedError) as cm:
+            self.rr.acquire(['Test:user:1'])
+        self.assertEqual(list(cm.exception.realms), ['Test:user:1'])
+        self.assertEqual(cm.exception.retry_after, 60)
+        # Each user has their own window, all counted against the parent
+        self.rr.acquire(['Test:user:2'])
+        self.assertEqual(self.rr.realm_occupancy('Test'), 3)
+        with self.assertRaises(RequestsRespectfulRateLimitedError) as cm:
+            self.rr.acquire(['Test:user:3'])
+        self.assertEqual(list(cm.exception.realms), ['Test'])
+
+    @mock.patch.object(requests, 'get')
+    def test_acquire_block(self, get):
+        self.rr.register_realm('Test', 15, 60)
+        with self.rr.acquire(['Test'], n=4) as permits:
+            self.assertEqual(self.rr.realm_occupancy('Test'), 4)
+            # All or nothing: a block too large for what's left gets none
+            with self.assertRaises(RequestsRespectfulRateLimitedError):
+                self.rr.acquire(['Test'], n=2)
+            self.assertEqual(self.rr.realm_occupancy('Test'), 4)
+            permits.request(lambda: requests.get('https://example.com'))
+            self.assertEqual(permits.remaining, 3)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(self.rr.realm_occupancy('Test'), 1)
+
+    @mock.patch.object(requests, 'get')
+    def test_throttling_decreases_then_recovers(self, get):
+        self.rr.register_realm('Test', 40, 60)
+        self.rr.register_throttle_detector(
+            'Test', lambda response: response.status_code == 601)
+        get.return_value = mock.Mock(status_code=601)
+        with self.assertRaises(RequestsRespectfulRateLimitedError) as cm:
+            self.rr.request(lambda: requests.get('https://example.com'),
+                            realms=['Test'])
+        self.assertEqual(cm.exception.retry_after, 60)
+        self.assertEqual(self.rr.realm_max_requests('Test'), 20)
+        # Climbs back one step once a timespan passed without throttling
+        get.return_value = mock.Mock(status_code=200)
+        self.now += 60000
+        self.rr.request(lambda: requests.get('https://example.com'),
+                        realms=['Test'])
+        self.assertEqual(self.rr.realm_max_requests('Test'), 21)
+
+    @mock.patch.object(requests.Session, 'send')
+    def test_validates_request_callables(self, send):
+        self.rr.register_realm('Test', 15, 60)
+        self.rr.get('https://example.com', realms=['Test'])
+        self.assertEqual(send.call_count, 1)
+        self.rr.request(lambda: requests.get('https://example.com'),
+                        realms=['Test'])
+        for request_func in [lambda: print('https://example.com'),
+                             functools.partial(print, 'https://example.com')]:
+            with self.assertRaises(RequestsRespectfulError):
+                self.rr.request(request_func, realms=['Test'])
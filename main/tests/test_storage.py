@@ -0,0 +1,96 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from datauploader import storage
+from datauploader.tasks import RECORDS_KEYS
+
+NOKIA_DATA = {
+    'measure': {'status': 0, 'body': {
+        'updatetime': 1500000000, 'timezone': 'Europe/Zürich',
+        'measuregrps': [
+            {'grpid': 1, 'date': 1500000000,
+             'measures': [{'value': 72.5, 'type': 1, 'unit': 0}]},
+            {'grpid': 2, 'date': 1500086400,
+             'measures': [{'value': 1e-05, 'type': 6, 'unit': -3}]},
+        ]}},
+    'intraday': {'status': 0, 'body': {'series': {
+        '1500000000': {'steps': 12, 'duration': 60},
+        '1500000060': {'steps': 0.5, 'duration': 60},
+    }}},
+    'sleep': {'status': 0, 'body': {'series': []}},
+    'activity': {'status': 0, 'body': {}},
+}
+
+
+class WriteFileTestCase(SimpleTestCase):
+    """
+    Test writing data files in every format, and reading them back.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.expected = json.dumps(NOKIA_DATA)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def existing_file(self):
+        path = os.path.join(self.directory, 'existing.json')
+        with open(path, 'w') as json_file:
+            json.dump(NOKIA_DATA, json_file)
+        return storage.NokiaFile(path, basename='nokiahealthdata.json')
+
+    def write(self, nokia_data, file_format='json'):
+        path = os.path.join(self.directory, 'nokiahealthdata' +
+                            storage.FILE_FORMATS[file_format])
+        sha256 = storage.write_file(path, nokia_data, file_format,
+                                    RECORDS_KEYS)
+        return path, sha256
+
+    def read(self, path):
+        with mock.patch('datauploader.storage.download_file', shutil.copy):
+            return storage.NokiaFile.download(path, os.path.basename(path))
+
+    def test_json_matches_json_dump(self):
+        path, sha256 = self.write(NOKIA_DATA)
+        with open(path) as json_file:
+            self.assertEqual(json_file.read(), self.expected)
+        self.assertEqual(
+            sha256, hashlib.sha256(self.expected.encode('utf-8')).hexdigest())
+
+    def test_existing_file_matches_json_dump(self):
+        existing = self.existing_file()
+        # One section parsed and written from memory, the others copied
+        existing['measure']
+        path, _ = self.write(existing)
+        with open(path) as json_file:
+            self.assertEqual(json_file.read(), self.expected)
+
+    def test_ndjson_round_trip(self):
+        for nokia_data in [NOKIA_DATA, self.existing_file()]:
+            path, _ = self.write(nokia_data, 'ndjson')
+            nokia_file = self.read(path)
+            try:
+                with open(nokia_file.path) as json_file:
+                    self.assertEqual(json_file.read(), self.expected)
+            finally:
+                nokia_file.close()
+
+    def test_gzip_round_trip(self):
+        path, sha256 = self.write(NOKIA_DATA, 'json.gz')
+        with gzip.open(path, 'rt', encoding='utf-8') as json_file:
+            self.assertEqual(json_file.read(), self.expected)
+        self.assertEqual(
+            sha256, hashlib.sha256(self.expected.encode('utf-8')).hexdigest())
+        nokia_file = self.read(path)
+        try:
+            self.assertEqual(dict(nokia_file.items()), NOKIA_DATA)
+        finally:
+            nokia_file.close()
@@ -0,0 +1,231 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from celery.exceptions import Retry
+from django.test import TestCase
+
+from datauploader import storage, tasks
+from main.models import NokiaSyncCursor
+from main.tests.test_update_data import make_member
+from nokia.settings import rr
+from requests_respectful import RequestsRespectfulRateLimitedError
+
+
+class ProcessNokiaTestCase(TestCase):
+    """
+    Test starting a member's sync.
+    """
+
+    def tearDown(self):
+        rr.redis.delete('nokia:sync:1', 'nokia:sync:1:rerun')
+
+    @mock.patch('datauploader.tasks.process_nokia.apply_async')
+    @mock.patch('datauploader.tasks.start_cursors')
+    def test_rate_limited_start_requeues(self, start_cursors, apply_async):
+        start_cursors.side_effect = RequestsRespectfulRateLimitedError(
+            retry_after=12.5)
+        tasks.process_nokia('1', concurrent=True)
+        apply_async.assert_called_once_with(
+            args=['1'], kwargs={'concurrent': True}, countdown=13)
+        self.assertIsNone(rr.redis.get('nokia:sync:1'))
+
+
+class FakeOpenHumans(object):
+    """
+    The member's files in Open Humans, kept in a temporary directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def exchange_oauth2_member(self, access_token):
+        return {'data': [
+            {'basename': basename, 'download_url': path,
+             'metadata': metadata}
+            for basename, (path, metadata) in self.files.items()]}
+
+    def upload_aws(self, out_file, metadata, access_token,
+                   project_member_id):
+        path = os.path.join(self.directory, os.path.basename(out_file))
+        shutil.copy(out_file, path)
+        self.files[os.path.basename(out_file)] = (path, metadata)
+
+    def delete_file(self, access_token, project_member_id,
+                    file_basename=None):
+        self.files.pop(file_basename, None)
+
+
+class FakeWithings(object):
+    """
+    Withings answering every request with the next page of records queued
+    for its action, and a new updatetime each time like getmeas does. The
+    request numbered refuse_at runs into the rate limit.
+    """
+
+    def __init__(self):
+        self.pages = {}
+        self.params = []
+        self.refuse_at = None
+
+    def get(self, url, params, realms):
+        self.params.append(params)
+        if len(self.params) == self.refuse_at:
+            raise RequestsRespectfulRateLimitedError(retry_after=1)
+        endpoint = [endpoint for endpoint in tasks.NOKIA_ENDPOINTS
+                    if endpoint['action'] == params['action']][0]
+        pages = self.pages.get(params['action'], [])
+        body = {endpoint['records']: pages.pop(0) if pages else [],
+                'updatetime': 1500000000 + len(self.params),
+                'timezone': 'Europe/Berlin'}
+        if pages:
+            body.update({'more': True, 'offset': len(self.params)})
+        response = mock.Mock()
+        response.json.return_value = {'status': 0, 'body': body}
+        return response
+
+
+class SyncTestCase(TestCase):
+    """
+    Test running the fetch and upload tasks of whole syncs.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.open_humans = FakeOpenHumans(self.directory)
+        self.withings = FakeWithings()
+        nokia_member = make_member(
+            '1', datetime.now(timezone.utc) - timedelta(days=5))
+        for endpoint in tasks.NOKIA_ENDPOINTS:
+            NokiaSyncCursor.objects.create(
+                member=nokia_member, endpoint=endpoint['name'],
+                synced_until=datetime.now(timezone.utc) - timedelta(days=1))
+        patchers = [
+            mock.patch('datauploader.tasks.api', self.open_humans),
+            mock.patch('datauploader.tasks.rr.get', self.withings.get,
+                       create=True),
+            mock.patch('datauploader.storage.download_file', shutil.copy),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        rr.redis.delete('nokia:sync:1', 'nokia:sync:1:rerun')
+
+    def sync(self, run_id):
+        stop_time = datetime.now(timezone.utc).timestamp()
+        for endpoint in tasks.NOKIA_ENDPOINTS:
+            tasks.fetch_nokia_endpoint('1', run_id, endpoint['name'],
+                                       stop_time, 'token')
+        tasks.upload_nokia('1', run_id, 'token')
+
+    def test_syncs_without_new_records_upload_nothing(self):
+        self.withings.pages['getmeas'] = [
+            [{'grpid': 1, 'date': 1500000000, 'measures': []}]]
+        self.sync('first')
+        self.assertEqual(list(self.open_humans.files),
+                         ['nokiahealthdata.json'])
+        with mock.patch.object(self.open_humans, 'upload_aws') as upload_aws:
+            self.sync('second')
+            self.sync('third')
+        upload_aws.assert_not_called()
+
+    def test_sections_without_new_records_are_not_parsed(self):
+        self.withings.pages['getmeas'] = [
+            [{'grpid': 1, 'date': 1500000000, 'measures': []}]]
+        self.sync('first')
+        self.withings.pages['getmeas'] = [
+            [{'grpid': 2, 'date': 1500086400, 'measures': []}]]
+        with mock.patch('datauploader.storage.ijson.items',
+                        wraps=storage.ijson.items) as items:
+            self.sync('second')
+        # The touched section's records are streamed, the others copied
+        self.assertEqual([call[0][1] for call in items.call_args_list],
+                         ['measure.body.measuregrps.item'])
+
+    def test_touched_sections_are_merged_as_they_stream(self):
+        self.withings.pages['getintradayactivity'] = [
+            {'1500000000': {'steps': 1}, '1500000120': {'steps': 3}}]
+        self.sync('first')
+        self.withings.pages['getintradayactivity'] = [
+            {'1500000060': {'steps': 2}, '1500000120': {'steps': 4}}]
+        with mock.patch('datauploader.storage.ijson.items',
+                        wraps=storage.ijson.items) as items, \
+                mock.patch('datauploader.storage.ijson.kvitems',
+                           wraps=storage.ijson.kvitems) as kvitems:
+            self.sync('second')
+        # Never parsed as a whole, its existing points streamed instead
+        self.assertEqual(items.call_args_list, [])
+        self.assertEqual([call[0][1] for call in kvitems.call_args_list],
+                         ['intraday.body.series'])
+        path = self.open_humans.files['nokiahealthdata.json'][0]
+        with open(path) as json_file:
+            series = json.load(json_file)['intraday']['body']['series']
+        self.assertEqual(list(series.items()), [
+            ('1500000000', {'steps': 1}), ('1500000060', {'steps': 2}),
+            ('1500000120', {'steps': 4})])
+
+    def test_partitions_merge_their_months(self):
+        self.withings.pages['getmeas'] = [
+            [{'grpid': 1, 'date': 1502000000, 'measures': []},
+             {'grpid': 2, 'date': 1500000000, 'measures': []}]]
+        self.sync('first')
+        with self.settings(NOKIA_FILE_LAYOUT='partitioned'), \
+                mock.patch('datauploader.storage.download_json',
+                           lambda path: json.load(open(path))):
+            self.withings.pages['getmeas'] = [
+                [{'grpid': 3, 'date': 1500086400, 'measures': []}]]
+            self.sync('second')
+            self.withings.pages['getmeas'] = [
+                [{'grpid': 4, 'date': 1499990000, 'measures': []}]]
+            self.sync('third')
+        grpids = {}
+        for month in ['2017-07', '2017-08']:
+            path = self.open_humans.files[
+                'nokiahealthdata-measure-{}.json'.format(month)][0]
+            with open(path) as json_file:
+                grpids[month] = [
+                    group['grpid'] for group in
+                    json.load(json_file)['measure']['body']['measuregrps']]
+        self.assertEqual(grpids, {'2017-07': [4, 2, 3], '2017-08': [1]})
+        self.assertNotIn('nokiahealthdata.json', self.open_humans.files)
+
+    @mock.patch('datauploader.tasks.process_nokia.apply_async')
+    def test_rate_limited_sync_requeues_once_released(self, apply_async):
+        rr.redis.set('nokia:sync:1', 'token')
+        # A dashboard sync asked for while this one ran
+        rr.redis.set('nokia:sync:1:rerun', 'concurrent')
+        leases = []
+        apply_async.side_effect = lambda **kwargs: leases.append(
+            rr.redis.get('nokia:sync:1'))
+        self.withings.refuse_at = 1
+        with mock.patch.object(tasks.fetch_nokia_endpoint, 'max_retries', 0):
+            self.sync('run')
+        apply_async.assert_called_once_with(
+            args=['1'], kwargs={'concurrent': True}, countdown=1)
+        self.assertEqual(leases, [None])
+        self.assertIsNone(rr.redis.get('nokia:sync:1:rerun'))
+
+    def test_rate_limited_fetch_resumes_where_it_stopped(self):
+        self.withings.pages['getmeas'] = [
+            [{'grpid': 1, 'date': 1500000000, 'measures': []}],
+            [{'grpid': 2, 'date': 1500086400, 'measures': []}]]
+        self.withings.refuse_at = 2
+        stop_time = datetime.now(timezone.utc).timestamp()
+        with self.assertRaises(Retry):
+            tasks.fetch_nokia_endpoint('1', 'run', 'measure', stop_time,
+                                       'token')
+        tasks.fetch_nokia_endpoint('1', 'run', 'measure', stop_time, 'token')
+        self.assertEqual(self.withings.params[-1]['offset'], 1)
+        tasks.upload_nokia('1', 'run', 'token')
+        path = self.open_humans.files['nokiahealthdata.json'][0]
+        with open(path) as json_file:
+            measuregrps = json.load(json_file)['measure']['body'][
+                'measuregrps']
+        self.assertEqual([group['grpid'] for group in measuregrps], [1, 2])
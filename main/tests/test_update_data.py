@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from main.models import NokiaHealthMember
+from open_humans.models import OpenHumansMember
+
+
+def make_member(oh_id, last_updated):
+    user = User.objects.create(username='{}_openhumans'.format(oh_id))
+    oh_member = OpenHumansMember.objects.create(
+        user=user, oh_id=oh_id, access_token='oh', refresh_token='oh',
+        token_expires=datetime.now(timezone.utc) + timedelta(days=1))
+    return NokiaHealthMember.objects.create(
+        user=oh_member, userid='u{}'.format(oh_id), deviceid='',
+        access_token='nokia', last_updated=last_updated)
+
+
+class UpdateDataTestCase(TestCase):
+    """
+    Test selecting and scheduling the members due for an update.
+    """
+
+    def setUp(self):
+        now = datetime.now(timezone.utc)
+        make_member('1', now - timedelta(days=10))
+        make_member('2', now - timedelta(days=5))
+        make_member('3', now - timedelta(days=1))
+
+    @mock.patch('main.management.commands.update_data.process_nokia')
+    def test_schedules_due_members_oldest_first(self, process_nokia):
+        call_command('update_data')
+        scheduled = [call[1]['args'][0]
+                     for call in process_nokia.apply_async.call_args_list]
+        self.assertEqual(scheduled, ['1', '2'])
+        countdowns = [call[1]['countdown']
+                      for call in process_nokia.apply_async.call_args_list]
+        self.assertEqual(countdowns[0], 0)
+        self.assertGreater(countdowns[1], 0)
+
+    @mock.patch('main.management.commands.update_data.BATCH_SIZE', 1)
+    @mock.patch('main.management.commands.update_data.process_nokia')
+    def test_batches_cover_every_due_member(self, process_nokia):
+        call_command('update_data')
+        self.assertEqual(process_nokia.apply_async.call_count, 2)
+
+    @mock.patch('main.management.commands.update_data.SCHEDULE_HORIZON', 10)
+    @mock.patch('main.management.commands.update_data.process_nokia')
+    def test_leaves_members_past_the_horizon(self, process_nokia):
+        call_command('update_data')
+        scheduled = [call[1]['args'][0]
+                     for call in process_nokia.apply_async.call_args_list]
+        self.assertEqual(scheduled, ['1'])
@@ -135,7 +135,7 @@ def remove_nokia(request):
 def update_data(request):
     if request.method == "POST" and request.user.is_authenticated:
         oh_member = request.user.oh_member
-        process_nokia.delay(oh_member.oh_id)
+        process_nokia.delay(oh_member.oh_id, concurrent=True)
         nokia_member = oh_member.nokia_member
         nokia_member.last_submitted = arrow.now().format()
         nokia_member.save()
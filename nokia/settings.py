@@ -14,6 +14,7 @@ import os
 import dj_database_url
 import logging
 from requests_respectful import RespectfulRequester
+from datauploader.withings import is_throttled
 
 logger = logging.getLogger(__name__)
 
@@ -64,6 +65,11 @@ NOKIA_CLIENT_SECRET = os.getenv('NOKIA_CLIENT_SECRET')
 NOKIA_CONSUMER_KEY = os.getenv('NOKIA_CONSUMER_KEY')
 NOKIA_CONSUMER_SECRET = os.getenv('NOKIA_CONSUMER_SECRET')
 WITHINGS_REDIRECT_URI = os.getenv('WITHINGS_REDIRECT_URI')
+# 'single' uploads all data as one nokiahealthdata.json, 'partitioned' as one
+# file per endpoint and month plus a manifest listing them.
+NOKIA_FILE_LAYOUT = os.getenv('NOKIA_FILE_LAYOUT', 'single')
+# Format of the uploaded data files: 'json', 'json.gz' or 'ndjson'
+NOKIA_FILE_FORMAT = os.getenv('NOKIA_FILE_FORMAT', 'json')
 
 if REMOTE is True:
     from urllib.parse import urlparse
@@ -83,6 +89,13 @@ if REMOTE is True:
 # Requests Respectful (rate limiting, waiting)
 rr = RespectfulRequester()
 rr.register_realm("Nokia", max_requests=120, timespan=60)
+# Per-Withings-user budgets nested under the application-wide one, so one
+# heavy member can't starve the others.
+rr.register_realm("Nokia:user:*", max_requests=60, timespan=60)
+rr.register_realm("Nokia:user:*:intraday", max_requests=30, timespan=60)
+rr.configure_session("Nokia", timeout=60, max_retries=2)
+# Back off when Withings reports throttling (status 601) and ramp back up.
+rr.register_throttle_detector("Nokia", is_throttled)
 
 if REMOTE:
     NOKIA_CALLBACK_URL = 'http://oh-nokiahealth-integration.herokuapp.com/complete_nokia'
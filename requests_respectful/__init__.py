@@ -13,4 +13,10 @@ __author__ = "Nicholas Brochu"
 __version__ = "0.1.2"
 
 from .respectful_requester import RespectfulRequester
+from .metrics import Metrics, RedisMetricsExporter, render_prometheus
 from .exceptions import *
+
+try:
+    from .async_respectful_requester import AsyncRespectfulRequester
+except ImportError:  # redis>=4.2 and httpx are only needed for asyncio
+    pass
@@ -0,0 +1,213 @@
+from .globals import config
+from .exceptions import RequestsRespectfulRateLimitedError, RequestsRespectfulRedisError
+from .base import BaseRespectfulRequester
+from .scripts import ACQUIRE_SCRIPT, ADJUST_SCRIPT
+
+from redis.asyncio import StrictRedis
+from redis.exceptions import ConnectionError
+
+import asyncio
+import time
+
+import httpx
+
+
+class AsyncRespectfulRequester(BaseRespectfulRequester):
+    # asyncio counterpart of RespectfulRequester. It shares the realms
+    # registered through RespectfulRequester and draws permits from the same
+    # Redis keys, so both can spend one realm budget side by side:
+    #
+    #     arr = AsyncRespectfulRequester()
+    #     response = await arr.get(url, realms=["Nokia"], wait=True)
+    #
+    # Realms are registered and updated through RespectfulRequester. Metrics
+    # stay in this process unless self.metrics is given an exporter.
+
+    def __init__(self):
+        super(AsyncRespectfulRequester, self).__init__()
+
+        self.redis = StrictRedis(
+            host=config["redis"]["host"],
+            port=config["redis"]["port"],
+            password=config["redis"]["password"],
+            db=config["redis"]["database"]
+        )
+
+        self._acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+        self._adjust_script = self.redis.register_script(ADJUST_SCRIPT)
+
+        self._clients = dict()
+
+    def __getattr__(self, attr):
+        if attr in ["delete", "get", "head", "options", "patch", "post", "put"]:
+            return lambda *args, **kwargs: self._requests_proxy(attr, *args, **kwargs)
+        else:
+            raise AttributeError()
+
+    async def ping(self):
+        try:
+            await self.redis.echo("Testing Connection")
+        except ConnectionError:
+            raise RequestsRespectfulRedisError("Could not establish a connection to the provided Redis server")
+
+        return True
+
+    async def request(self, request_func, realms=None, wait=False):
+        # request_func is called without arguments and must return an awaitable
+        await self._validate_realms(realms)
+
+        waited = 0
+
+        while True:
+            try:
+                response = await self._perform_request(request_func, realms=realms)
+                break
+            except RequestsRespectfulRateLimitedError as e:
+                if not wait:
+                    raise
+
+                await asyncio.sleep(e.retry_after)
+                waited += e.retry_after
+
+        if wait:
+            self.metrics.observe("wait_seconds", self._metric_realms(self._realm_levels(realms)), waited)
+
+        return response
+
+    async def reserve(self, realms):
+        await self._validate_realms(realms)
+
+        rate_limited_realms = await self._acquire_permits(realms)
+
+        if not len(rate_limited_realms):
+            return 0
+
+        return max(rate_limited_realms.values())
+
+    async def fetch_registered_realms(self):
+        return list(map(lambda k: k.decode("utf-8"), await self.redis.smembers(self._realms_redis_key())))
+
+    async def realm_max_requests(self, realm):
+        return (await self._cached_realm_info(realm))["max_requests"]
+
+    async def realm_timespan(self, realm):
+        return (await self._cached_realm_info(realm))["timespan"]
+
+    async def configure_session(self, realm, **kwargs):
+        self._update_session_options(realm, **kwargs)
+        client = self._clients.pop(realm, None)
+
+        if client is not None:
+            await client.aclose()
+
+        return True
+
+    def client(self, realm):
+        # One keep-alive client per realm, configured from the same session
+        # options as RespectfulRequester's pooled sessions. Its retries only
+        # cover failed connection attempts.
+        if realm not in self._clients:
+            options = self.session_options(realm)
+
+            limits = httpx.Limits(
+                max_connections=options["pool_maxsize"],
+                max_keepalive_connections=options["pool_maxsize"] if options["keep_alive"] else 0
+            )
+
+            self._clients[realm] = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(retries=options["max_retries"], limits=limits),
+                timeout=options["timeout"]
+            )
+
+        return self._clients[realm]
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+
+        for client in clients:
+            await client.aclose()
+
+        await self.redis.close()
+
+        return True
+
+    async def _perform_request(self, request_func, realms=None):
+        rate_limited_realms = await self._acquire_permits(realms)
+
+        if not len(rate_limited_realms):
+            started_at = time.time()
+
+            try:
+                response = await request_func()
+            finally:
+                self.metrics.observe("upstream_seconds", self._metric_realms(self._realm_levels(realms)), time.time() - started_at)
+
+            await self._adapt_realms(realms, response)
+
+            return response
+        else:
+            raise self._rate_limited_error(rate_limited_realms)
+
+    async def _adapt_realms(self, realms, response):
+        adjustments = self._throttle_adjustments(realms, response)
+
+        if not len(adjustments):
+            return
+
+        for registered_realm, direction in adjustments:
+            await self._adjust_script(keys=self._adjust_keys(registered_realm), args=self._adjust_args(registered_realm, direction))
+
+        self._invalidate_realms_cache()
+
+        throttled_realms = [registered_realm for registered_realm, direction in adjustments if direction == "decrease"]
+
+        if len(throttled_realms):
+            raise self._throttled_error(throttled_realms)
+
+    async def _validate_realms(self, realms):
+        for realm in realms:
+            await self._cached_realm_info(realm)
+
+    async def _cached_realm_info(self, realm):
+        if self._realms_cache_needs_load(realm):
+            await self._load_realms_cache()
+
+        return self._lookup_realm_info(realm)
+
+    async def _load_realms_cache(self):
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.get(self._realms_version_redis_key())
+        pipeline.smembers(self._realms_redis_key())
+        version, realms = await pipeline.execute()
+
+        realms = list(realms)
+        pipeline = self.redis.pipeline(transaction=False)
+
+        for realm in realms:
+            pipeline.hgetall(self._realm_redis_key(realm.decode("utf-8")))
+
+        self._store_realms_cache(version, realms, await pipeline.execute())
+
+    async def _acquire_permits(self, realms):
+        await self._validate_realms(realms)
+
+        levels, level_counts = self._realm_level_counts(self._permit_counts(realms))
+        _, args = self._acquire_args(level_counts)
+
+        started_at = time.time()
+        reply = await self._acquire_script(keys=self._acquire_keys(levels), args=args)
+        rate_limited_realms = self._parse_acquire_reply(levels, reply)
+
+        self._record_acquisition(levels, level_counts, rate_limited_realms, time.time() - started_at)
+
+        return rate_limited_realms
+
+    # Requests proxy
+    async def _requests_proxy(self, method, *args, **kwargs):
+        realms, wait = self._pop_proxy_kwargs(kwargs)
+
+        # Requests go through the pooled client of the first realm's root
+        client = self.client(realms[0].split(":")[0])
+
+        return await self.request(lambda: getattr(client, method)(*args, **kwargs), realms=realms, wait=wait)
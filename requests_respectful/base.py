@@ -0,0 +1,299 @@
+from .globals import default_config, config
+from .exceptions import RequestsRespectfulError, RequestsRespectfulConfigError, RequestsRespectfulRateLimitedError
+from .metrics import Metrics
+
+import collections
+import time
+import uuid
+
+import warnings
+
+
+class BaseRespectfulRequester:
+    # Realm model and Redis key layout shared by RespectfulRequester and
+    # AsyncRespectfulRequester. Everything here is free of I/O so both the
+    # blocking and the asyncio clients can build on it.
+    #
+    # Realms nest on ":" (e.g. "Nokia" > "Nokia:user:42" > "Nokia:user:42:intraday")
+    # and a permit is only granted when every registered level has room.
+    # A level takes its limits from a realm registered under its own name or
+    # from a template where "*" stands for one segment, like "Nokia:user:*".
+
+    def __init__(self):
+        self._realms_cache = None
+        self._realms_cache_version = None
+        self._realms_cache_expires_at = 0
+
+        self._session_options = dict()
+
+        self.metrics = Metrics()
+
+        self._throttle_detectors = dict()
+        self._throttle_recovery_checked_at = dict()
+
+    @property
+    def redis_prefix(self):
+        return "RespectfulRequester"
+
+    def session_options(self, realm):
+        return dict(config["session"], **self._session_options.get(realm, dict()))
+
+    def register_throttle_detector(self, realm, detector, decrease_factor=0.5, increase_step=1):
+        # Adapts a registered realm's max_requests to upstream throttling.
+        # detector gets every response made in the realm and returns True when
+        # the service throttled it, for services that say so in the body
+        # rather than with a 429. Throttling multiplies max_requests by
+        # decrease_factor and raises a rate-limited error for the request;
+        # max_requests then climbs back by increase_step per timespan up to
+        # the value it was registered or last updated with.
+        self._throttle_detectors[realm] = (detector, decrease_factor, increase_step)
+
+        return True
+
+    def _update_session_options(self, realm, **kwargs):
+        unknown_session_keys = set(kwargs) - set(default_config["session"])
+
+        if len(unknown_session_keys):
+            raise RequestsRespectfulConfigError("'%s' %s not valid in the session options" % (
+                ", ".join(sorted(unknown_session_keys)),
+                "is" if len(unknown_session_keys) == 1 else "are"
+            ))
+
+        self._session_options[realm] = dict(self._session_options.get(realm, dict()), **kwargs)
+
+    # Realm configuration cache
+    def _realms_cache_needs_load(self, realm):
+        # The cache is reloaded when its TTL lapses, when the realms version
+        # reported by Redis moved on, or once when asked for a realm it
+        # doesn't know about yet.
+        return self._realms_cache is None or \
+            time.time() >= self._realms_cache_expires_at or \
+            self._resolve_realm(realm) is None
+
+    def _lookup_realm_info(self, realm):
+        registered_realm = self._resolve_realm(realm)
+
+        if registered_realm is None:
+            raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+
+        return self._realms_cache[registered_realm]
+
+    def _resolve_realm(self, realm):
+        # Returns the registered realm holding the limits of this one: itself,
+        # or the most specific matching template.
+        if realm in self._realms_cache:
+            return realm
+
+        segments = realm.split(":")
+        templates = list()
+
+        for template in self._realms_cache:
+            template_segments = template.split(":")
+
+            if "*" in template_segments and len(template_segments) == len(segments) and \
+                    all(t == "*" or t == s for t, s in zip(template_segments, segments)):
+                templates.append(template)
+
+        if not len(templates):
+            return None
+
+        return min(templates, key=lambda template: (template.count("*"), template))
+
+    def _realm_levels(self, realms):
+        # Expands realms to every registered level above and including them,
+        # as (realm, registered realm) pairs.
+        levels = collections.OrderedDict()
+
+        for realm in realms:
+            segments = realm.split(":")
+
+            for depth in range(1, len(segments) + 1):
+                level = ":".join(segments[:depth])
+                registered_realm = self._resolve_realm(level)
+
+                if registered_realm is not None:
+                    levels[level] = registered_realm
+
+        return list(levels.items())
+
+    def _realm_level_counts(self, counts):
+        # Adds up how many permits each level needs for the given realm counts,
+        # as (realm, registered realm) pairs and the matching permit counts.
+        level_counts = collections.OrderedDict()
+        registered_realms = dict()
+
+        for realm, count in counts.items():
+            for level, registered_realm in self._realm_levels([realm]):
+                level_counts[level] = level_counts.get(level, 0) + count
+                registered_realms[level] = registered_realm
+
+        return [(level, registered_realms[level]) for level in level_counts], list(level_counts.values())
+
+    @staticmethod
+    def _metric_realms(levels):
+        # Metrics are labelled with registered realms, templates included
+        return list(collections.OrderedDict.fromkeys(registered_realm for _, registered_realm in levels))
+
+    def _record_acquisition(self, levels, level_counts, rate_limited_realms, seconds):
+        self.metrics.observe("acquire_seconds", self._metric_realms(levels), seconds)
+
+        if not len(rate_limited_realms):
+            for (_, registered_realm), count in zip(levels, level_counts):
+                self.metrics.increment("permits_granted_total", [registered_realm], count)
+        else:
+            self.metrics.increment("permits_denied_total", self._metric_realms(
+                [level for level in levels if level[0] in rate_limited_realms]
+            ))
+
+    @staticmethod
+    def _permit_counts(realms, n=1):
+        # Permits wanted per realm: either a {realm: count} mapping already,
+        # or a list of realms that each need n of them.
+        if isinstance(realms, dict):
+            return collections.OrderedDict(realms)
+
+        return collections.OrderedDict((realm, n) for realm in realms)
+
+    def _store_realms_cache(self, version, realms, realm_infos):
+        realms_cache = dict()
+
+        for realm, realm_info in zip(realms, realm_infos):
+            if b"max_requests" in realm_info and b"timespan" in realm_info:
+                realms_cache[realm.decode("utf-8")] = {
+                    "max_requests": int(realm_info[b"max_requests"].decode("utf-8")),
+                    "timespan": int(realm_info[b"timespan"].decode("utf-8")),
+                    "ceiling": int(realm_info.get(b"ceiling", realm_info[b"max_requests"]).decode("utf-8"))
+                }
+
+        self._realms_cache = realms_cache
+        self._realms_cache_version = int(version or 0)
+        self._realms_cache_expires_at = time.time() + config["realm_cache_ttl"]
+
+    def _invalidate_realms_cache(self):
+        # Stale entries stay readable until the next lookup reloads them
+        self._realms_cache_expires_at = 0
+
+    # Permit acquisition
+    def _acquire_keys(self, levels):
+        keys = [self._realms_version_redis_key()]
+
+        for realm, registered_realm in levels:
+            keys.extend([self._realm_redis_key(registered_realm), self._permits_redis_key(realm)])
+
+        return keys
+
+    def _acquire_args(self, level_counts):
+        permit_id = str(uuid.uuid4())
+
+        return permit_id, [self._now_ms(), config["safety_threshold"], permit_id] + level_counts
+
+    @staticmethod
+    def _permit_members(permit_id, levels, level_counts):
+        # The permits the acquire script hands out to each level
+        return collections.OrderedDict(
+            (level, ["%s:%d" % (permit_id, permit) for permit in range(1, count + 1)])
+            for (level, _), count in zip(levels, level_counts)
+        )
+
+    def _parse_acquire_reply(self, levels, reply):
+        # Returns the rate-limited realms, mapped to the seconds until one of
+        # their permits expires. Drops the realm cache if it went stale.
+        if int(reply[0]) != self._realms_cache_version:
+            self._invalidate_realms_cache()
+
+        denied = reply[1:]
+        rate_limited_realms = collections.OrderedDict()
+
+        for index, wait in zip(denied[::2], denied[1::2]):
+            rate_limited_realms[levels[int(index)][0]] = max(int(wait), 0) / 1000.0
+
+        return rate_limited_realms
+
+    # Adaptive limits
+    def _throttle_adjustments(self, realms, response):
+        # The (registered realm, "decrease" or "increase") adjustments due for
+        # a response. Increases are only proposed for realms running below
+        # their ceiling, and at most once per timespan from each process, so
+        # healthy traffic doesn't cost an extra round trip per request.
+        adjustments = list()
+
+        if not len(self._throttle_detectors):
+            return adjustments
+
+        for registered_realm in self._metric_realms(self._realm_levels(realms)):
+            if registered_realm not in self._throttle_detectors:
+                continue
+
+            if self._throttle_detectors[registered_realm][0](response):
+                adjustments.append((registered_realm, "decrease"))
+                continue
+
+            realm_info = self._realms_cache[registered_realm]
+            checked_at = self._throttle_recovery_checked_at.get(registered_realm, 0)
+
+            if realm_info["max_requests"] < realm_info["ceiling"] and time.time() >= checked_at + realm_info["timespan"]:
+                self._throttle_recovery_checked_at[registered_realm] = time.time()
+                adjustments.append((registered_realm, "increase"))
+
+        return adjustments
+
+    def _adjust_keys(self, registered_realm):
+        return [self._realm_redis_key(registered_realm), self._realms_version_redis_key()]
+
+    def _adjust_args(self, registered_realm, direction):
+        _, decrease_factor, increase_step = self._throttle_detectors[registered_realm]
+
+        return [self._now_ms(), direction, decrease_factor, increase_step, config["safety_threshold"] + 1]
+
+    def _throttled_error(self, throttled_realms):
+        self.metrics.increment("throttled_total", throttled_realms)
+
+        return self._rate_limited_error(collections.OrderedDict(
+            (realm, float(self._realms_cache[realm]["timespan"])) for realm in throttled_realms
+        ))
+
+    @staticmethod
+    def _rate_limited_error(rate_limited_realms):
+        return RequestsRespectfulRateLimitedError(
+            "Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms),
+            retry_after=max(rate_limited_realms.values()),
+            realms=rate_limited_realms
+        )
+
+    @staticmethod
+    def _pop_proxy_kwargs(kwargs):
+        realm = kwargs.pop("realm", None)
+        realms = kwargs.pop("realms", list())
+
+        if realm:
+            warnings.warn("'realm' kwarg will be removed in favor of providing a 'realms' list starting in 0.3.0", DeprecationWarning)
+            realms.append(realm)
+
+        if not len(realms):
+            raise RequestsRespectfulError("'realms' is a required kwarg")
+
+        return realms, kwargs.pop("wait", False)
+
+    # Redis keys
+    def _realm_redis_key(self, realm):
+        return "%s:REALMS:%s" % (self.redis_prefix, realm)
+
+    def _realms_redis_key(self):
+        return "%s:REALMS" % self.redis_prefix
+
+    def _realms_version_redis_key(self):
+        return "%s:REALMS_VERSION" % self.redis_prefix
+
+    def _permits_redis_key(self, realm):
+        return "%s:PERMITS:%s" % (self.redis_prefix, realm)
+
+    def _metrics_redis_key(self):
+        return "%s:METRICS" % self.redis_prefix
+
+    @staticmethod
+    def _now_ms():
+        return int(time.time() * 1000)
+
+    @staticmethod
+    def _config():
+        return config
@@ -4,7 +4,14 @@ class RequestsRespectfulError(Exception):
 
 
 class RequestsRespectfulRateLimitedError(Exception):
-    pass
+
+    def __init__(self, message=None, retry_after=None, realms=None):
+        super(RequestsRespectfulRateLimitedError, self).__init__(message)
+
+        # Seconds until every rate-limited realm has a permit available again
+        self.retry_after = retry_after
+        # Seconds until a permit frees up, per rate-limited realm
+        self.realms = realms or dict()
 
 
 class RequestsRespectfulConfigError(Exception):
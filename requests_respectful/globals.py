@@ -20,7 +20,17 @@ default_config = {
         "database": 0
     },
     "safety_threshold": 10,
-    "requests_module_name": "requests"
+    "requests_module_name": "requests",
+    "realm_cache_ttl": 60,
+    "lease_size": 0,
+    "lease_ttl": 1,
+    "metrics_flush_interval": 10,
+    "session": {
+        "pool_maxsize": 10,
+        "keep_alive": True,
+        "timeout": None,
+        "max_retries": 0
+    }
 }
 
 try:
@@ -43,6 +53,58 @@ try:
                 "'requests_module_name' key must be a string in 'requests-respectful.config.yml'"
             )
 
+    if "realm_cache_ttl" not in config:
+        config["realm_cache_ttl"] = default_config.get("realm_cache_ttl")
+    else:
+        if type(config["realm_cache_ttl"]) != int or config["realm_cache_ttl"] < 0:
+            raise RequestsRespectfulConfigError(
+                "'realm_cache_ttl' key must be a positive integer in 'requests-respectful.config.yml'"
+            )
+
+    if "lease_size" not in config:
+        config["lease_size"] = default_config.get("lease_size")
+    else:
+        if type(config["lease_size"]) != int or config["lease_size"] < 0:
+            raise RequestsRespectfulConfigError(
+                "'lease_size' key must be a positive integer in 'requests-respectful.config.yml'"
+            )
+
+    if "lease_ttl" not in config:
+        config["lease_ttl"] = default_config.get("lease_ttl")
+    else:
+        if type(config["lease_ttl"]) not in (int, float) or config["lease_ttl"] < 0:
+            raise RequestsRespectfulConfigError(
+                "'lease_ttl' key must be a positive number in 'requests-respectful.config.yml'"
+            )
+
+    if "metrics_flush_interval" not in config:
+        config["metrics_flush_interval"] = default_config.get("metrics_flush_interval")
+    else:
+        if type(config["metrics_flush_interval"]) != int or config["metrics_flush_interval"] < 0:
+            raise RequestsRespectfulConfigError(
+                "'metrics_flush_interval' key must be a positive integer in 'requests-respectful.config.yml'"
+            )
+
+    if "session" not in config:
+        config["session"] = copy.deepcopy(default_config.get("session"))
+    else:
+        if type(config["session"]) != dict:
+            raise RequestsRespectfulConfigError(
+                "'session' key must be a dict in 'requests-respectful.config.yml'"
+            )
+
+        unknown_session_keys = set(config["session"]) - set(default_config["session"])
+
+        if len(unknown_session_keys):
+            raise RequestsRespectfulConfigError(
+                "'%s' %s not valid in the 'session' configuration key in 'requests-respectful.config.yml'" % (
+                    ", ".join(sorted(unknown_session_keys)),
+                    "is" if len(unknown_session_keys) == 1 else "are"
+                )
+            )
+
+        config["session"] = dict(default_config["session"], **config["session"])
+
     if "redis" not in config:
         raise RequestsRespectfulConfigError("'redis' key is missing from 'requests-respectful.config.yml'")
 
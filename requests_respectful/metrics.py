@@ -0,0 +1,158 @@
+from .globals import config
+
+import collections
+import json
+import threading
+import time
+
+
+# Metric families, as (type, help) by name. Samples are keyed by
+# (name, realm, bucket bound), histograms following the Prometheus layout of
+# cumulative "_bucket" counts plus "_sum" and "_count".
+METRICS = collections.OrderedDict([
+    ("permits_granted_total", ("counter", "Permits granted")),
+    ("permits_denied_total", ("counter", "Permit acquisitions denied by the rate limit")),
+    ("throttled_total", ("counter", "Responses the upstream service throttled")),
+    ("acquire_seconds", ("histogram", "Time spent acquiring permits from Redis")),
+    ("wait_seconds", ("histogram", "Time wait=True callers spent blocked by the rate limit")),
+    ("upstream_seconds", ("histogram", "Duration of the requests made with a permit")),
+    ("window_occupancy", ("gauge", "Permits in flight within the realm's timespan")),
+    ("realm_max_requests", ("gauge", "Registered max_requests of the realm"))
+])
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metrics:
+    # Per-realm counters and latency histograms of a requester. Samples are
+    # labelled with the registered realm, so "Nokia:user:*" adds up every
+    # user's realm instead of growing a series per user.
+    #
+    # With an exporter, the increase since the last export is handed to it at
+    # most every 'metrics_flush_interval' seconds, so workers can aggregate
+    # their samples somewhere shared.
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+
+        self._samples = collections.defaultdict(float)
+        self._exported_samples = dict()
+        self._exported_at = time.time()
+        self._lock = threading.Lock()
+
+    def increment(self, name, realms, value=1):
+        with self._lock:
+            for realm in realms:
+                self._samples[(name, realm, None)] += value
+
+    def observe(self, name, realms, seconds):
+        with self._lock:
+            for realm in realms:
+                for bucket in BUCKETS:
+                    if seconds <= bucket:
+                        self._samples[(name + "_bucket", realm, repr(float(bucket)))] += 1
+
+                self._samples[(name + "_bucket", realm, "+Inf")] += 1
+                self._samples[(name + "_sum", realm, None)] += seconds
+                self._samples[(name + "_count", realm, None)] += 1
+
+    def samples(self):
+        with self._lock:
+            return dict(self._samples)
+
+    def collect(self):
+        # Everything exported so far when there's an exporter, or this
+        # process's samples otherwise
+        if self.exporter is None:
+            return self.samples()
+
+        self.flush(force=True)
+
+        return self.exporter.collect()
+
+    def flush(self, force=False):
+        if self.exporter is None:
+            return False
+
+        with self._lock:
+            if not force and time.time() - self._exported_at < config["metrics_flush_interval"]:
+                return False
+
+            increases = dict(
+                (key, value - self._exported_samples.get(key, 0)) for key, value in self._samples.items()
+                if value != self._exported_samples.get(key, 0)
+            )
+
+            self._exported_samples = dict(self._samples)
+            self._exported_at = time.time()
+
+        if len(increases):
+            self.exporter.export(increases)
+
+        return True
+
+
+class RedisMetricsExporter:
+    # Adds every worker's samples up in one Redis hash
+
+    def __init__(self, redis, redis_key):
+        self.redis = redis
+        self.redis_key = redis_key
+
+    def export(self, increases):
+        pipeline = self.redis.pipeline(transaction=False)
+
+        for key, value in increases.items():
+            pipeline.hincrbyfloat(self.redis_key, json.dumps(key), value)
+
+        pipeline.execute()
+
+    def collect(self):
+        return dict(
+            (tuple(json.loads(field.decode("utf-8"))), float(value))
+            for field, value in self.redis.hgetall(self.redis_key).items()
+        )
+
+
+def render_prometheus(samples, prefix="respectful"):
+    # Renders samples in the Prometheus text exposition format
+    lines = list()
+
+    for name, (metric_type, description) in METRICS.items():
+        if metric_type == "histogram":
+            series = [name + "_bucket", name + "_sum", name + "_count"]
+        else:
+            series = [name]
+
+        family = sorted(
+            (key for key in samples if key[0] in series),
+            key=lambda key: (key[1], series.index(key[0]), _bucket_bound(key[2]))
+        )
+
+        if not len(family):
+            continue
+
+        lines.append("# HELP %s_%s %s" % (prefix, name, description))
+        lines.append("# TYPE %s_%s %s" % (prefix, name, metric_type))
+
+        for key in family:
+            sample_name, realm, bucket = key
+            labels = 'realm="%s"' % realm.replace("\\", "\\\\").replace('"', '\\"')
+
+            if bucket is not None:
+                labels += ',le="%s"' % bucket
+
+            lines.append("%s_%s{%s} %s" % (prefix, sample_name, labels, _format_value(samples[key])))
+
+    return "\n".join(lines) + "\n"
+
+
+def _bucket_bound(bucket):
+    if bucket is None:
+        return 0
+
+    return float("inf") if bucket == "+Inf" else float(bucket)
+
+
+def _format_value(value):
+    return "%d" % value if float(value).is_integer() else repr(float(value))
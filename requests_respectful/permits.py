@@ -0,0 +1,110 @@
+from .globals import config
+
+import collections
+import threading
+import time
+
+
+class Permits:
+    # A block of permits reserved up front through RespectfulRequester.acquire().
+    # Requests made through it spend those permits instead of acquiring their
+    # own. Permits spent more than 'lease_ttl' seconds after the block was
+    # acquired are renewed first, so they cover the request's actual timespan.
+    # Leaving the with block hands unused permits back:
+    #
+    #     with rr.acquire(realms=["Nokia"], n=6) as permits:
+    #         permits.get(url, realms=["Nokia"])
+    #
+    # Requests beyond the block, or in realms it doesn't hold, acquire permits
+    # as usual.
+    #
+    # RespectfulRequester also uses Permits as per-process leases, which stop
+    # handing out permits once 'lease_ttl' seconds have passed.
+
+    def __init__(self, requester, counts, levels, members, expires_at=None):
+        self.requester = requester
+        self.realms = list(counts)
+        self.acquired_at = time.time()
+        self.expires_at = expires_at
+
+        self._remaining = dict(counts)
+        self._registered_realms = dict(levels)
+        self._realm_levels = dict(
+            (realm, [level for level, _ in requester._realm_levels([realm])]) for realm in counts
+        )
+        self._members = dict((level, collections.deque(permits)) for level, permits in members.items())
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __getattr__(self, attr):
+        if attr in ["delete", "get", "head", "options", "patch", "post", "put"]:
+            return lambda *args, **kwargs: self._requests_proxy(attr, *args, **kwargs)
+        else:
+            raise AttributeError()
+
+    @property
+    def remaining(self):
+        return sum(self._remaining.values())
+
+    def request(self, request_func, realms=None, wait=False):
+        realms = realms or self.realms[:1]
+        permits = self._take(realms)
+
+        if permits is None:
+            return self.requester.request(request_func, realms=realms, wait=wait)
+
+        self.requester._validate_request_func(request_func)
+
+        if time.time() - self.acquired_at > config["lease_ttl"]:
+            self.requester._renew_permits(permits)
+
+        return self.requester._timed_request(request_func, realms)
+
+    def release(self):
+        with self._lock:
+            members = dict((level, list(permits)) for level, permits in self._members.items())
+
+            for permits in self._members.values():
+                permits.clear()
+
+            for realm in self._remaining:
+                self._remaining[realm] = 0
+
+        self.requester._release_permits(members)
+
+        return True
+
+    def _take(self, realms):
+        # One permit per level of the realms, as (realm, registered realm,
+        # permit) triples, or None once a realm's share is spent or the lease
+        # expired
+        with self._lock:
+            if self.expires_at is not None and time.time() >= self.expires_at:
+                return None
+
+            if not all(self._remaining.get(realm) for realm in realms):
+                return None
+
+            levels = list()
+
+            for realm in realms:
+                self._remaining[realm] -= 1
+
+                for level in self._realm_levels[realm]:
+                    if level not in levels:
+                        levels.append(level)
+
+            return [(level, self._registered_realms[level], self._members[level].popleft()) for level in levels]
+
+    def _requests_proxy(self, method, *args, **kwargs):
+        realms = kwargs.pop("realms", None) or self.realms[:1]
+        wait = kwargs.pop("wait", False)
+
+        request_func = self.requester._session_request_func(realms, method, *args, **kwargs)
+
+        return self.request(request_func, realms=realms, wait=wait)
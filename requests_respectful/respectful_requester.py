@@ -1,20 +1,31 @@
 from .globals import default_config, config, redis
 from .exceptions import RequestsRespectfulError, RequestsRespectfulConfigError, RequestsRespectfulRateLimitedError, RequestsRespectfulRedisError
+from .base import BaseRespectfulRequester
+from .metrics import Metrics, RedisMetricsExporter, render_prometheus
+from .permits import Permits
+from .scripts import ACQUIRE_SCRIPT, ADJUST_SCRIPT, RENEW_SCRIPT
 
 from redis import StrictRedis, ConnectionError
 
-import uuid
-import inspect
+import dis
+import functools
+import threading
 import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import warnings
 
 
-class RespectfulRequester:
+class RespectfulRequester(BaseRespectfulRequester):
+
+    _validated_request_codes = set()
 
     def __init__(self):
+        super(RespectfulRequester, self).__init__()
+
         self.redis = redis
 
         try:
@@ -22,47 +33,111 @@ class RespectfulRequester:
         except ConnectionError:
             raise RequestsRespectfulRedisError("Could not establish a connection to the provided Redis server")
 
+        self._acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+        self._renew_script = self.redis.register_script(RENEW_SCRIPT)
+        self._adjust_script = self.redis.register_script(ADJUST_SCRIPT)
+
+        self._sessions = dict()
+        self._sessions_lock = threading.Lock()
+
+        self._leases = dict()
+        self._leases_lock = threading.Lock()
+
+        self.metrics = Metrics(RedisMetricsExporter(self.redis, self._metrics_redis_key()))
+
     def __getattr__(self, attr):
         if attr in ["delete", "get", "head", "options", "patch", "post", "put"]:
             return getattr(self, "_requests_proxy_%s" % attr)
         else:
             raise AttributeError()
 
-    @property
-    def redis_prefix(self):
-        return "RespectfulRequester"
-
     def request(self, request_func, realm=None, realms=None, wait=False):
         if realm is not None:
             warnings.warn("'realm' kwarg will be removed in favor of providing a 'realms' list starting in 0.3.0", DeprecationWarning)
             realms = [realm]
 
-        registered_realms = self.fetch_registered_realms()
-
-        for r in realms:
-            if r not in registered_realms:
-                raise RequestsRespectfulError("Realm '%s' hasn't been registered" % realm)
+        self._validate_realms(realms)
 
         if wait:
+            waited = 0
+
             while True:
                 try:
-                    return self._perform_request(request_func, realms=realms)
-                except RequestsRespectfulRateLimitedError:
-                    pass
+                    response = self._perform_request(request_func, realms=realms)
+                    break
+                except RequestsRespectfulRateLimitedError as e:
+                    time.sleep(e.retry_after)
+                    waited += e.retry_after
 
-                time.sleep(1)
+            self.metrics.observe("wait_seconds", self._metric_realms(self._realm_levels(realms)), waited)
+
+            return response
         else:
             return self._perform_request(request_func, realms=realms)
 
+    def reserve(self, realms):
+        self._validate_realms(realms)
+
+        rate_limited_realms = self._acquire_permits(realms)
+
+        if not len(rate_limited_realms):
+            return 0
+
+        return max(rate_limited_realms.values())
+
+    def acquire(self, realms, n=1, wait=False):
+        # Reserves n permits in every realm (or {realm: count} permits) all at
+        # once, or none at all. Use the returned Permits as a context manager
+        # so whatever wasn't spent goes back to the realms on exit.
+        counts = self._permit_counts(realms, n)
+        self._validate_realms(list(counts))
+
+        for (level, _), count in zip(*self._realm_level_counts(counts)):
+            if count > self.realm_max_requests(level) - config["safety_threshold"]:
+                raise RequestsRespectfulError("Realm '%s' can never grant %d permits at once" % (level, count))
+
+        waited = 0
+
+        while True:
+            rate_limited_realms, levels, members = self._acquire_permit_counts(counts)
+
+            if not len(rate_limited_realms):
+                if wait:
+                    self.metrics.observe("wait_seconds", self._metric_realms(levels), waited)
+
+                return Permits(self, counts, levels, members)
+            elif not wait:
+                raise self._rate_limited_error(rate_limited_realms)
+
+            time.sleep(max(rate_limited_realms.values()))
+            waited += max(rate_limited_realms.values())
+
     def fetch_registered_realms(self):
-        return list(map(lambda k: k.decode("utf-8"), self.redis.smembers("%s:REALMS" % self.redis_prefix)))
+        return list(map(lambda k: k.decode("utf-8"), self.redis.smembers(self._realms_redis_key())))
+
+    def realm_occupancy(self, realm):
+        return self._requests_in_timespan(realm)
+
+    def metrics_text(self):
+        # Prometheus text exposition of the samples every worker exported,
+        # plus the current window occupancy of each registered realm.
+        # Templates have no window of their own and only report samples.
+        samples = self.metrics.collect()
+
+        for realm in self.fetch_registered_realms():
+            if "*" not in realm.split(":"):
+                samples[("window_occupancy", realm, None)] = self.realm_occupancy(realm)
+                samples[("realm_max_requests", realm, None)] = self.realm_max_requests(realm)
+
+        return render_prometheus(samples)
 
     def register_realm(self, realm, max_requests, timespan):
         redis_key = self._realm_redis_key(realm)
 
         if not self.redis.hexists(redis_key, "max_requests"):
             self.redis.hmset(redis_key, {"max_requests": max_requests, "timespan": timespan})
-            self.redis.sadd("%s:REALMS" % self.redis_prefix, realm)
+            self.redis.sadd(self._realms_redis_key(), realm)
+            self._bump_realms_version()
 
         return True
 
@@ -80,14 +155,18 @@ class RespectfulRequester:
             if updatable_key in kwargs and type(kwargs[updatable_key]) == int:
                 self.redis.hset(redis_key, updatable_key, kwargs[updatable_key])
 
+        # Adaptive limits climb back up to the max_requests set here
+        if "max_requests" in kwargs and type(kwargs["max_requests"]) == int:
+            self.redis.hset(redis_key, "ceiling", kwargs["max_requests"])
+
+        self._bump_realms_version()
+
         return True
 
     def unregister_realm(self, realm):
-        self.redis.delete(self._realm_redis_key(realm))
-        self.redis.srem("%s:REALMS" % self.redis_prefix, realm)
-
-        request_keys = self.redis.keys("%s:REQUEST:%s:*" % (self.redis_prefix, realm))
-        [self.redis.delete(k) for k in request_keys]
+        self.redis.delete(self._realm_redis_key(realm), self._permits_redis_key(realm))
+        self.redis.srem(self._realms_redis_key(), realm)
+        self._bump_realms_version()
 
         return True
 
@@ -97,13 +176,62 @@ class RespectfulRequester:
 
         return True
 
+    def configure_session(self, realm, **kwargs):
+        with self._sessions_lock:
+            self._update_session_options(realm, **kwargs)
+            session = self._sessions.pop(realm, None)
+
+        if session is not None:
+            session.close()
+
+        return True
+
+    def session(self, realm):
+        # One keep-alive session per realm, so calls to the same service reuse
+        # warm connections. Its retries only cover failed connection attempts:
+        # those never reached the service, so they don't spend its budget.
+        with self._sessions_lock:
+            if realm not in self._sessions:
+                options = self.session_options(realm)
+
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=options["pool_maxsize"],
+                    max_retries=Retry(
+                        total=options["max_retries"],
+                        connect=options["max_retries"],
+                        read=0,
+                        status=0,
+                        raise_on_status=False
+                    )
+                )
+
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+
+                if not options["keep_alive"]:
+                    session.headers["Connection"] = "close"
+
+                self._sessions[realm] = session
+
+            return self._sessions[realm]
+
+    def close_sessions(self):
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for session in sessions:
+            session.close()
+
+        return True
+
     def realm_max_requests(self, realm):
-        realm_info = self._fetch_realm_info(realm)
-        return int(realm_info["max_requests".encode("utf-8")].decode("utf-8"))
+        return self._cached_realm_info(realm)["max_requests"]
 
     def realm_timespan(self, realm):
-        realm_info = self._fetch_realm_info(realm)
-        return int(realm_info["timespan".encode("utf-8")].decode("utf-8"))
+        return self._cached_realm_info(realm)["timespan"]
 
     @classmethod
     def configure(cls, **kwargs):
@@ -146,6 +274,44 @@ class RespectfulRequester:
 
             config["requests_module_name"] = kwargs["requests_module_name"]
 
+        if "realm_cache_ttl" in kwargs:
+            if type(kwargs["realm_cache_ttl"]) != int or kwargs["realm_cache_ttl"] < 0:
+                raise RequestsRespectfulConfigError("'realm_cache_ttl' key must be a positive integer")
+
+            config["realm_cache_ttl"] = kwargs["realm_cache_ttl"]
+
+        if "lease_size" in kwargs:
+            if type(kwargs["lease_size"]) != int or kwargs["lease_size"] < 0:
+                raise RequestsRespectfulConfigError("'lease_size' key must be a positive integer")
+
+            config["lease_size"] = kwargs["lease_size"]
+
+        if "lease_ttl" in kwargs:
+            if type(kwargs["lease_ttl"]) not in (int, float) or kwargs["lease_ttl"] < 0:
+                raise RequestsRespectfulConfigError("'lease_ttl' key must be a positive number")
+
+            config["lease_ttl"] = kwargs["lease_ttl"]
+
+        if "metrics_flush_interval" in kwargs:
+            if type(kwargs["metrics_flush_interval"]) != int or kwargs["metrics_flush_interval"] < 0:
+                raise RequestsRespectfulConfigError("'metrics_flush_interval' key must be a positive integer")
+
+            config["metrics_flush_interval"] = kwargs["metrics_flush_interval"]
+
+        if "session" in kwargs:
+            if type(kwargs["session"]) != dict:
+                raise RequestsRespectfulConfigError("'session' key must be a dict")
+
+            unknown_session_keys = set(kwargs["session"]) - set(default_config["session"])
+
+            if len(unknown_session_keys):
+                raise RequestsRespectfulConfigError("'%s' %s not valid in the 'session' configuration key" % (
+                    ", ".join(sorted(unknown_session_keys)),
+                    "is" if len(unknown_session_keys) == 1 else "are"
+                ))
+
+            config["session"] = dict(config["session"], **kwargs["session"])
+
         return config
 
     @classmethod
@@ -158,63 +324,182 @@ class RespectfulRequester:
     def _perform_request(self, request_func, realms=None):
         self._validate_request_func(request_func)
 
-        rate_limited_realms = list()
+        if config["lease_size"] > 1:
+            rate_limited_realms = self._lease_permit(realms)
+        else:
+            rate_limited_realms = self._acquire_permits(realms)
+
+        if not len(rate_limited_realms):
+            return self._timed_request(request_func, realms)
+        else:
+            raise self._rate_limited_error(rate_limited_realms)
+
+    def _timed_request(self, request_func, realms):
+        started_at = time.time()
+
+        try:
+            response = request_func()
+        finally:
+            self.metrics.observe("upstream_seconds", self._metric_realms(self._realm_levels(realms)), time.time() - started_at)
+            self.metrics.flush()
+
+        self._adapt_realms(realms, response)
+
+        return response
+
+    def _adapt_realms(self, realms, response):
+        adjustments = self._throttle_adjustments(realms, response)
+
+        if not len(adjustments):
+            return
+
+        for registered_realm, direction in adjustments:
+            self._adjust_script(keys=self._adjust_keys(registered_realm), args=self._adjust_args(registered_realm, direction))
 
+        self._invalidate_realms_cache()
+
+        throttled_realms = [registered_realm for registered_realm, direction in adjustments if direction == "decrease"]
+
+        if len(throttled_realms):
+            raise self._throttled_error(throttled_realms)
+
+    def _validate_realms(self, realms):
         for realm in realms:
-            if not self._can_perform_request(realm):
-                rate_limited_realms.append(realm)
+            self._cached_realm_info(realm)
 
-        if not len(rate_limited_realms):
-            for realm in realms:
-                request_uuid = str(uuid.uuid4())
+    def _cached_realm_info(self, realm):
+        if self._realms_cache_needs_load(realm):
+            self._load_realms_cache()
 
-                self.redis.setex(
-                    name="%s:REQUEST:%s:%s" % (self.redis_prefix, realm, request_uuid),
-                    time=self.realm_timespan(realm),
-                    value=request_uuid
-                )
+        return self._lookup_realm_info(realm)
+
+    def _load_realms_cache(self):
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.get(self._realms_version_redis_key())
+        pipeline.smembers(self._realms_redis_key())
+        version, realms = pipeline.execute()
+
+        realms = list(realms)
+        pipeline = self.redis.pipeline(transaction=False)
+
+        for realm in realms:
+            pipeline.hgetall(self._realm_redis_key(realm.decode("utf-8")))
+
+        self._store_realms_cache(version, realms, pipeline.execute())
+
+    def _bump_realms_version(self):
+        self.redis.incr(self._realms_version_redis_key())
+        self._invalidate_realms_cache()
+
+    def _acquire_permits(self, realms):
+        # Checks and acquires a permit in every realm in a single round trip.
+        # Returns the rate-limited realms, mapped to the seconds until one of
+        # their permits expires; nothing is acquired then.
+        return self._acquire_permit_counts(self._permit_counts(realms))[0]
+
+    def _acquire_permit_counts(self, counts):
+        self._validate_realms(list(counts))
 
-            return request_func()
+        levels, level_counts = self._realm_level_counts(counts)
+        permit_id, args = self._acquire_args(level_counts)
+
+        started_at = time.time()
+        reply = self._acquire_script(keys=self._acquire_keys(levels), args=args)
+        rate_limited_realms = self._parse_acquire_reply(levels, reply)
+
+        self._record_acquisition(levels, level_counts, rate_limited_realms, time.time() - started_at)
+
+        return rate_limited_realms, levels, self._permit_members(permit_id, levels, level_counts)
+
+    def _lease_permit(self, realms):
+        # Hands out a permit from this process's lease on the realms without
+        # a round trip. Once the lease is spent or 'lease_ttl' has passed, its
+        # leftovers go back and a new lease of 'lease_size' permits is taken,
+        # or a single permit when the realms can't spare that many. Leased
+        # permits expire like any other, so a crashed worker can't leak budget,
+        # and a realm may run up to 'lease_ttl' seconds ahead of its limit.
+        lease_key = tuple(realms)
+
+        with self._leases_lock:
+            lease = self._leases.pop(lease_key, None)
+
+            if lease is not None and lease._take(realms) is not None:
+                self._leases[lease_key] = lease
+                return dict()
+
+        if lease is not None:
+            lease.release()
+
+        for size in (config["lease_size"], 1):
+            counts = self._permit_counts(realms, size)
+            rate_limited_realms, levels, members = self._acquire_permit_counts(counts)
+
+            if not len(rate_limited_realms):
+                break
         else:
-            raise RequestsRespectfulRateLimitedError("Currently rate-limited on Realm(s): %s" % ", ".join(rate_limited_realms))
+            return rate_limited_realms
 
-    def _realm_redis_key(self, realm):
-        return "%s:REALMS:%s" % (self.redis_prefix, realm)
+        lease = Permits(self, counts, levels, members, expires_at=time.time() + config["lease_ttl"])
+        lease._take(realms)
 
-    def _fetch_realm_info(self, realm):
-        redis_key = self._realm_redis_key(realm)
-        return self.redis.hgetall(redis_key)
+        with self._leases_lock:
+            previous_lease = self._leases.pop(lease_key, None)
+            self._leases[lease_key] = lease
 
-    def _requests_in_timespan(self, realm):
-        return len(
-            self.redis.scan(
-                cursor=0,
-                match="%s:REQUEST:%s:*" % (self.redis_prefix, realm),
-                count=self._redis_keys_in_db() + 100
-            )[1]
-        )
+        if previous_lease is not None:
+            previous_lease.release()
 
-    def _redis_keys_in_db(self):
-        return self.redis.info().get("db%d" % config["redis"]["database"]).get("keys")
+        return dict()
 
-    def _can_perform_request(self, realm):
-        return self._requests_in_timespan(realm) < (self.realm_max_requests(realm) - config["safety_threshold"])
+    def release_leases(self):
+        with self._leases_lock:
+            leases = list(self._leases.values())
+            self._leases.clear()
+
+        for lease in leases:
+            lease.release()
+
+        return True
+
+    def _renew_permits(self, permits):
+        # Restarts the timespan of (realm, registered realm, permit) triples
+        # taken from a block acquired ahead of the request spending them
+        keys = list()
+
+        for realm, registered_realm, _ in permits:
+            keys.extend([self._realm_redis_key(registered_realm), self._permits_redis_key(realm)])
+
+        self._renew_script(keys=keys, args=[self._now_ms()] + [permit for _, _, permit in permits])
+
+    def _release_permits(self, members):
+        pipeline = self.redis.pipeline(transaction=False)
+
+        for realm, permits in members.items():
+            if len(permits):
+                pipeline.zrem(self._permits_redis_key(realm), *permits)
+
+        pipeline.execute()
+
+    def _requests_in_timespan(self, realm):
+        return self.redis.zcount(self._permits_redis_key(realm), "(%d" % self._now_ms(), "+inf")
 
     # Requests proxy
     def _requests_proxy(self, method, *args, **kwargs):
-        realm = kwargs.pop("realm", None)
-        realms = kwargs.pop("realms", list())
+        realms, wait = self._pop_proxy_kwargs(kwargs)
 
-        if realm:
-            warnings.warn("'realm' kwarg will be removed in favor of providing a 'realms' list starting in 0.3.0", DeprecationWarning)
-            realms.append(realm)
+        return self.request(self._session_request_func(realms, method, *args, **kwargs), realms=realms, wait=wait)
 
-        if not len(realms):
-            raise RequestsRespectfulError("'realms' is a required kwarg")
+    def _session_request_func(self, realms, method, *args, **kwargs):
+        # Requests go through the pooled session of the first realm's root,
+        # so nested realms like "Nokia:user:42" share the "Nokia" session
+        session_realm = realms[0].split(":")[0]
+        session = self.session(session_realm)
+        timeout = self.session_options(session_realm)["timeout"]
 
-        wait = kwargs.pop("wait", False)
+        if timeout is not None:
+            kwargs.setdefault("timeout", timeout)
 
-        return self.request(lambda: getattr(requests, method)(*args, **kwargs), realms=realms, wait=wait)
+        return functools.partial(getattr(session, method), *args, **kwargs)
 
     def _requests_proxy_delete(self, *args, **kwargs):
         return self._requests_proxy("delete", *args, **kwargs)
@@ -237,14 +522,32 @@ class RespectfulRequester:
     def _requests_proxy_put(self, *args, **kwargs):
         return self._requests_proxy("put", *args, **kwargs)
 
-    @staticmethod
-    def _validate_request_func(request_func):
-        request_func_string = inspect.getsource(request_func)
-        post_lambda_string = request_func_string.split(":")[1].strip()
+    @classmethod
+    def _validate_request_func(cls, request_func):
+        # Proxied requests are partials of a pooled session's methods and are
+        # checked as such. Other callables are checked by the names their
+        # bytecode loads first rather than by their source, which is slow to
+        # read and missing from frozen or zipped deployments. Results are
+        # cached per code object.
+        if isinstance(request_func, functools.partial) and \
+                isinstance(getattr(request_func.func, "__self__", None), requests.Session):
+            return
+
+        code = getattr(request_func, "__code__", None)
+        cache_key = (code, config["requests_module_name"])
+
+        if cache_key in cls._validated_request_codes:
+            return
+
+        if code is None:
+            raise RequestsRespectfulError("The request lambda can only contain a requests function call")
+
+        loaded_names = [
+            instruction.argval for instruction in dis.get_instructions(code)
+            if instruction.opname in ("LOAD_GLOBAL", "LOAD_NAME", "LOAD_DEREF", "LOAD_FAST")
+        ][:2]
 
-        if not post_lambda_string.startswith(config["requests_module_name"]) and not post_lambda_string.startswith("getattr(requests"):
+        if loaded_names[:1] != [config["requests_module_name"]] and loaded_names != ["getattr", "requests"]:
             raise RequestsRespectfulError("The request lambda can only contain a requests function call")
 
-    @staticmethod
-    def _config():
-        return config
+        cls._validated_request_codes.add(cache_key)
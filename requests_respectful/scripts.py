@@ -0,0 +1,126 @@
+"""
+    Lua scripts run server-side by RespectfulRequester.
+
+    Every realm owns a sorted set of permits scored by their expiry time in
+    milliseconds. Scripts receive the realms version key followed by
+    (realm info hash, realm permits sorted set) key pairs so that several
+    realms are checked and acquired atomically, and report the realms version
+    so callers can tell when their cached realm configuration went stale.
+"""
+
+# KEYS: realms version, then (realm info hash, realm permits) pairs
+# ARGV: now (ms), safety threshold, permit id, then the number of permits to
+#       acquire in each realm
+# Returns the realms version followed by a flat list of (realm index, ms until
+# enough permits free up) for every rate-limited realm. Nothing is acquired
+# unless that list is empty; otherwise realm n gets the permits
+# "<permit id>:1" to "<permit id>:<count n>".
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local threshold = tonumber(ARGV[2])
+local reply = {tonumber(redis.call("GET", KEYS[1])) or 0}
+
+for i = 2, #KEYS, 2 do
+    local max_requests = tonumber(redis.call("HGET", KEYS[i], "max_requests"))
+    local count = tonumber(ARGV[3 + i / 2])
+
+    if not max_requests then
+        return redis.error_reply("Realm hash '" .. KEYS[i] .. "' does not exist")
+    end
+
+    redis.call("ZREMRANGEBYSCORE", KEYS[i + 1], "-inf", now)
+
+    local limit = max_requests - threshold
+    local in_flight = redis.call("ZCARD", KEYS[i + 1])
+
+    if in_flight + count > limit then
+        local wait = tonumber(redis.call("HGET", KEYS[i], "timespan")) * 1000
+
+        if limit >= count then
+            local index = in_flight + count - limit - 1
+            local frees_at = redis.call("ZRANGE", KEYS[i + 1], index, index, "WITHSCORES")
+            wait = tonumber(frees_at[2]) - now
+        end
+
+        table.insert(reply, (i - 2) / 2)
+        table.insert(reply, wait)
+    end
+end
+
+if #reply == 1 then
+    for i = 2, #KEYS, 2 do
+        local timespan = tonumber(redis.call("HGET", KEYS[i], "timespan")) * 1000
+
+        for permit = 1, tonumber(ARGV[3 + i / 2]) do
+            redis.call("ZADD", KEYS[i + 1], now + timespan, ARGV[3] .. ":" .. permit)
+        end
+
+        redis.call("PEXPIRE", KEYS[i + 1], timespan)
+    end
+end
+
+return reply
+"""
+
+# KEYS: (realm info hash, realm permits) pairs
+# ARGV: now (ms), then the permit to renew in each realm
+# Restarts the given permits' timespan from now, for permits acquired ahead
+# of the request they end up being spent on.
+RENEW_SCRIPT = """
+local now = tonumber(ARGV[1])
+
+for i = 1, #KEYS, 2 do
+    local timespan = tonumber(redis.call("HGET", KEYS[i], "timespan")) * 1000
+
+    redis.call("ZADD", KEYS[i + 1], now + timespan, ARGV[1 + (i + 1) / 2])
+    redis.call("PEXPIRE", KEYS[i + 1], timespan)
+end
+
+return #KEYS / 2
+"""
+
+# KEYS: realm info hash, realms version
+# ARGV: now (ms), "decrease" or "increase", decrease factor, increase step,
+#       lowest max_requests
+# Adjusts a realm's max_requests the AIMD way: multiplied by the factor on
+# throttling, at most once per timespan so one throttled window only counts
+# once, and raised by the step back towards its registered ceiling once a
+# full timespan went by without any adjustment. Returns the new max_requests,
+# or nil when nothing changed.
+ADJUST_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_requests = tonumber(redis.call("HGET", KEYS[1], "max_requests"))
+
+if not max_requests then
+    return nil
+end
+
+redis.call("HSETNX", KEYS[1], "ceiling", max_requests)
+
+local ceiling = tonumber(redis.call("HGET", KEYS[1], "ceiling"))
+local timespan = tonumber(redis.call("HGET", KEYS[1], "timespan")) * 1000
+local adjusted
+local since
+
+if ARGV[2] == "decrease" then
+    since = tonumber(redis.call("HGET", KEYS[1], "decreased_at")) or 0
+    adjusted = math.max(tonumber(ARGV[5]), math.floor(max_requests * tonumber(ARGV[3])))
+else
+    since = tonumber(redis.call("HGET", KEYS[1], "adjusted_at")) or 0
+    adjusted = math.min(ceiling, max_requests + tonumber(ARGV[4]))
+end
+
+if now - since < timespan or adjusted == max_requests then
+    return nil
+end
+
+redis.call("HSET", KEYS[1], "max_requests", adjusted, "adjusted_at", now)
+
+if ARGV[2] == "decrease" then
+    redis.call("HSET", KEYS[1], "decreased_at", now)
+end
+
+redis.call("INCR", KEYS[2])
+
+return adjusted
+"""